@@ -0,0 +1,299 @@
+"""降噪流程效能基準測試
+
+在本機產生合成的「語音 + 噪音」測試檔 (多種長度、取樣率與容器格式)，以無介面方式執行實際的處理流程 (run_pipeline)，
+記錄各階段耗時、即時倍率 (RTF = 處理耗時 / 音訊長度，越小越快) 與峰值記憶體 (RSS)，結果輸出為 JSON，
+並可與先前儲存的基準結果比較。每個測試組合都在獨立的子行程中執行，峰值記憶體才不會互相影響。
+
+用法：
+    python benchmarks/bench_pipeline.py --durations 30 300 --formats wav mp4 --chunk-sec 5 10 --threads 1 4 \\
+        --backends torch int8 torchscript --skip-silence 0 1 --pcm-cache off cold warm --checkpoint 0 1 \\
+        --output bench.json
+    python benchmarks/bench_pipeline.py --output new.json --baseline bench.json --tolerance 0.15
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import itertools
+import subprocess
+import tempfile
+import threading
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+FIXTURE_DIR = os.path.join(tempfile.gettempdir(), "denoise_bench_fixtures")
+# run_pipeline 記錄的階段 (解碼依輸入與快取狀態記為 extract / extract_direct / extract_cached 其中之一)
+STAGES = ("model_load", "probe", "extract", "extract_direct", "extract_cached", "enhance", "save", "normalize", "mux")
+
+
+# ================= 🎼 合成測試檔 =================
+def synth_noisy_speech(duration_sec, sr, seed=0):
+    """產生類語音訊號：基頻緩慢變化的諧波、每秒約 4 個音節的振幅包絡與停頓，再混入粉紅噪音 (SNR 約 5 dB)"""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    n = int(duration_sec * sr)
+    t = np.arange(n) / sr
+    f0 = 150 + 50 * np.sin(2 * np.pi * 0.3 * t) + 20 * np.sin(2 * np.pi * 2.1 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / sr
+    voice = sum(np.sin(k * phase) / k for k in range(1, 12))
+    syllables = np.clip(np.sin(2 * np.pi * 4 * t), 0, None) ** 2
+    pauses = (np.sin(2 * np.pi * 0.15 * t + rng.uniform(0, 2 * np.pi)) > -0.3).astype(np.float32)
+    speech = voice * syllables * pauses
+
+    white = rng.standard_normal(n)
+    spectrum = np.fft.rfft(white)
+    spectrum /= np.sqrt(np.maximum(np.arange(len(spectrum)), 1))
+    noise = np.fft.irfft(spectrum, n)
+
+    speech_rms = np.sqrt(np.mean(speech ** 2)) or 1.0
+    noise *= speech_rms / (np.sqrt(np.mean(noise ** 2)) * 10 ** (5 / 20))
+    mix = speech + noise
+    return (0.5 * mix / np.max(np.abs(mix))).astype(np.float32)
+
+
+def make_fixture(duration_sec, sr, fmt):
+    """產生 (或沿用已產生的) 測試檔；mp4 會附帶一條低解析度的黑畫面影像軌"""
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    path = os.path.join(FIXTURE_DIR, f"noisy_{int(duration_sec)}s_{sr}hz.{fmt}")
+    if os.path.exists(path):
+        return path
+    audio = synth_noisy_speech(duration_sec, sr)
+    cmd = ["ffmpeg", "-y", "-f", "f32le", "-ar", str(sr), "-ac", "1", "-i", "pipe:0"]
+    if fmt == "mp4":
+        cmd += ["-f", "lavfi", "-i", f"color=c=black:s=320x240:r=10:d={duration_sec}",
+                "-map", "1:v", "-map", "0:a", "-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac", "-shortest"]
+    elif fmt == "mp3":
+        cmd += ["-c:a", "libmp3lame", "-q:a", "2"]
+    else:
+        cmd += ["-c:a", "pcm_s16le"]
+    tmp_path = path + ".part." + fmt
+    subprocess.run(cmd + [tmp_path, "-hide_banner", "-loglevel", "error"], input=audio.tobytes(), check=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+# ================= ⏱️ 單一測試組合 (於子行程中執行) =================
+def _current_rss():
+    """讀取目前 RSS (bytes)；非 Linux 環境退回 ru_maxrss"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler:
+    """背景執行緒每 10ms 取樣一次 RSS，並依受測執行緒當下所在的階段 (denoise_metrics 的 span) 記錄各階段峰值
+
+    串流流程中解碼、降噪、寫入暫存交錯進行，因此以取樣當下的最內層階段歸屬，而不是以各階段的起訖時間。
+    不在任何階段中的取樣 (例如每段之間的寫入與峰值追蹤) 記為 other。
+    """
+
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.peaks = {}
+        self.overall = _current_rss()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        from denoise_metrics import current_stage
+
+        stage = current_stage(self.thread_id) or "other"
+        rss = _current_rss()
+        self.peaks[stage] = max(self.peaks.get(stage, 0), rss)
+        self.overall = max(self.overall, rss)
+
+    def _run(self):
+        while not self._done.wait(0.01):
+            self._sample()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+        self._sample()
+
+
+def run_case(case):
+    """以實際的 run_pipeline 處理測試檔 (與網頁、命令列相同的串流流程)，記錄各階段耗時與峰值 RSS
+
+    pcm_cache 為 off (不使用解碼快取) / cold (邊解碼邊寫入快取) / warm (先跑一次建立快取，量測讀取快取的第二次)；
+    checkpoint 為 1 時每段寫入檢查點 (網頁背景工作的預設)。
+    """
+    import torch
+    from denoise_engine import init_model
+    from denoise_metrics import span, summarize
+    from denoise_pipeline import run_pipeline, inspect_input, AUDIO_EXTENSIONS
+
+    torch.set_num_threads(case["threads"])
+    media_sec = case["duration_sec"]
+    work_dir = tempfile.mkdtemp(prefix="denoise_bench_")
+    is_audio_only = os.path.splitext(case["input_path"])[1].lower() in AUDIO_EXTENSIONS
+    output_path = os.path.join(work_dir, "out" + (os.path.splitext(case["input_path"])[1] if is_audio_only else ".mp4"))
+    spans = []
+
+    try:
+        with RssSampler(threading.get_ident()) as sampler:
+            with span(spans, "model_load"):
+                model, df_state = init_model(case["backend"])
+            with span(spans, "probe"):
+                media = inspect_input(case["input_path"])
+            options = dict(chunk_sec=case["chunk_sec"], batch_size=case["batch_size"], media=media,
+                           skip_silence=bool(case["skip_silence"]))
+            if case["pcm_cache"] != "off":
+                options["pcm_cache_path"] = os.path.join(work_dir, "input.f32")
+            if case["checkpoint"]:
+                options.update(checkpoint_path=os.path.join(work_dir, "checkpoint.json"),
+                               checkpoint_key={"input_hash": "bench"})
+            if case["pcm_cache"] == "warm":
+                # 建立快取的第一次處理不列入峰值 (只保留模型載入與檢查的峰值)
+                peaks, overall = dict(sampler.peaks), sampler.overall
+                run_pipeline(case["input_path"], output_path, 40, model, df_state, is_audio_only, **options)
+                sampler.peaks, sampler.overall = peaks, overall
+            stats = run_pipeline(case["input_path"], output_path, 40, model, df_state, is_audio_only,
+                                 spans=spans, **options)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    stages = {}
+    for stage, entry in summarize(spans).items():
+        stages[stage] = {
+            "seconds": entry["seconds"],
+            "count": entry["count"],
+            "rtf": round(entry["seconds"] / media_sec, 5) if media_sec else None,
+            "peak_rss_mb": round(sampler.peaks[stage] / (1024 * 1024), 1) if stage in sampler.peaks else None,
+        }
+    total = sum(stage["seconds"] for name, stage in stages.items() if name != "model_load")
+    skipped_ratio = stats["skipped_samples"] / stats["total_samples"] if stats.get("total_samples") else 0.0
+    return dict(case, stages=stages, total_seconds=round(total, 4), total_rtf=round(total / media_sec, 5),
+                peak_rss_mb=round(sampler.overall / (1024 * 1024), 1), skipped_ratio=round(skipped_ratio, 4))
+
+
+# ================= 📈 比較與報表 =================
+def case_id(case):
+    return (f"{int(case['duration_sec'])}s_{case['sample_rate']}hz_{case['format']}"
+            f"_chunk{case['chunk_sec']:g}_t{case['threads']}_b{case['batch_size']}_{case['backend']}"
+            f"_skip{case['skip_silence']}_pcm-{case['pcm_cache']}_ck{case['checkpoint']}")
+
+
+def compare(results, baseline, tolerance):
+    """與基準結果比較各階段耗時，回傳超出容許比例的退步項目"""
+    base_cases = {c["id"]: c for c in baseline.get("cases", [])}
+    regressions = []
+    for case in results["cases"]:
+        base = base_cases.get(case["id"])
+        if not base:
+            continue
+        for stage in STAGES:
+            new, old = case["stages"].get(stage), base["stages"].get(stage)
+            if not new or not old or stage == "model_load" or old["seconds"] < 0.05:
+                continue
+            ratio = new["seconds"] / old["seconds"]
+            if ratio > 1 + tolerance:
+                regressions.append({"id": case["id"], "stage": stage, "ratio": round(ratio, 3),
+                                    "old_seconds": old["seconds"], "new_seconds": new["seconds"]})
+    return regressions
+
+
+def print_table(results):
+    """各階段耗時 (秒) 與整次處理的 RTF、峰值 RSS；未出現的階段 (例如沒有快取時的 extract_cached) 顯示為 -"""
+    header = f"{'case':<80}" + "".join(f"{stage:>15}" for stage in STAGES) + f"{'RTF':>10}{'peakMB':>9}{'skip':>7}"
+    print(header)
+    print("-" * len(header))
+    for case in results["cases"]:
+        cells = (f"{case['stages'][s]['seconds']:>15.3f}" if s in case["stages"] else f"{'-':>15}" for s in STAGES)
+        print(f"{case['id']:<80}" + "".join(cells)
+              + f"{case['total_rtf']:>10.4f}{case['peak_rss_mb']:>9.0f}{case['skipped_ratio']:>7.0%}")
+
+
+def main(argv=None):
+    from denoise_engine import BACKENDS
+
+    parser = argparse.ArgumentParser(description="降噪流程各階段效能基準測試")
+    parser.add_argument("--durations", type=float, nargs="+", default=[30.0, 120.0], help="測試檔長度 (秒)")
+    parser.add_argument("--sample-rates", type=int, nargs="+", default=[48000], help="測試檔取樣率")
+    parser.add_argument("--formats", nargs="+", default=["wav", "mp4"], choices=["wav", "mp3", "mp4"], help="容器格式")
+    parser.add_argument("--chunk-sec", type=float, nargs="+", default=[10.0], help="串流引擎分段長度 (秒)")
+    parser.add_argument("--threads", type=int, nargs="+", default=[os.cpu_count() or 1], help="torch.set_num_threads")
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1], help="批次大小 (0 = 自動)")
+    parser.add_argument("--backends", nargs="+", default=["torch"], choices=BACKENDS,
+                        help="推論後端")
+    parser.add_argument("--skip-silence", type=int, nargs="+", default=[0], choices=[0, 1],
+                        help="靜音略過 (0 = 關閉、1 = 開啟)")
+    parser.add_argument("--pcm-cache", nargs="+", default=["off"], choices=["off", "cold", "warm"],
+                        help="解碼快取：off = 不使用、cold = 邊解碼邊寫入、warm = 從已建立的快取讀取")
+    parser.add_argument("--checkpoint", type=int, nargs="+", default=[0], choices=[0, 1],
+                        help="每段寫入續跑檢查點 (需搭配解碼快取，off 時略過此組合)")
+    parser.add_argument("--output", default="bench_results.json", help="結果 JSON 路徑")
+    parser.add_argument("--baseline", help="要比較的基準結果 JSON")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="允許的耗時增加比例 (預設 0.10 = 10%%)")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--case-output", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        # 子行程：模型載入時會在 stdout 印出日誌，所以結果另外寫入檔案
+        with open(args.case_output, "w", encoding="utf-8") as f:
+            json.dump(run_case(json.loads(args.case)), f)
+        return 0
+
+    cases = []
+    for duration, sr, fmt, chunk, threads, batch, backend, skip, pcm_cache, checkpoint in itertools.product(
+            args.durations, args.sample_rates, args.formats, args.chunk_sec, args.threads, args.batch_size,
+            args.backends, args.skip_silence, args.pcm_cache, args.checkpoint):
+        if checkpoint and pcm_cache == "off":
+            continue
+        case = {"duration_sec": duration, "sample_rate": sr, "format": fmt, "chunk_sec": chunk,
+                "threads": threads, "batch_size": batch, "backend": backend, "skip_silence": skip,
+                "pcm_cache": pcm_cache, "checkpoint": checkpoint, "input_path": make_fixture(duration, sr, fmt)}
+        case["id"] = case_id(case)
+        print(f"▶ {case['id']}", file=sys.stderr, flush=True)
+        case_output = os.path.join(FIXTURE_DIR, case["id"] + ".json")
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--case", json.dumps(case),
+                               "--case-output", case_output], capture_output=True, cwd=ROOT_DIR)
+        if proc.returncode != 0:
+            print(proc.stderr.decode("utf-8", errors="ignore"), file=sys.stderr)
+            return 1
+        with open(case_output, "r", encoding="utf-8") as f:
+            cases.append(json.load(f))
+        os.remove(case_output)
+
+    import torch
+    results = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {"python": platform.python_version(), "torch": torch.__version__,
+                        "platform": platform.platform(), "cpu_count": os.cpu_count()},
+        "cases": cases,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print_table(results)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        results["regressions"] = regressions
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        for item in regressions:
+            print(f"⚠️ 退步 {item['id']} / {item['stage']}: {item['old_seconds']}s → {item['new_seconds']}s "
+                  f"(x{item['ratio']})", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+
+# ================= 🗃️ 結果快取 (以內容雜湊為鍵) =================
+# 第一層：最終輸出檔，鍵 = (上傳檔 SHA-256, 降噪強度, 模型版本, 聲道處理方式, 是否略過靜音)
+# 第二層：解碼後的 48kHz PCM，鍵 = (上傳檔 SHA-256, 聲道配置) (換強度重跑時可略過 ffmpeg 提取)
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "denoise_cache")
+RESULTS_DIR = os.path.join(CACHE_DIR, "results")
+PCM_DIR = os.path.join(CACHE_DIR, "pcm")
+
+_lock = threading.Lock()
+
+
+def result_key(input_hash, atten_lim_db, model_version, channel_mode="", skip_silence=False):
+    """channel_mode 為聲道處理方式 (預設的單聲道為空字串，沿用既有的快取鍵)；
+    skip_silence 為 True 時 (靜音略過會改變輸出) 另外快取，關閉時同樣沿用既有的快取鍵"""
+    suffix = f":{channel_mode}" if channel_mode else ""
+    suffix += ":skip_silence" if skip_silence else ""
+    return hashlib.sha256(f"{input_hash}:{atten_lim_db}:{model_version}{suffix}".encode()).hexdigest()
+
+
+def _touch(path):
+    """更新存取時間，作為 LRU 淘汰依據"""
+    try:
+        os.utime(path, None)
+        return True
+    except OSError:
+        return False
+
+
+def _entries(directory):
+    """列出資料夾中的快取檔 [(最後使用時間, 大小, 路徑)]，寫入中的暫存檔不列入"""
+    entries = []
+    if not os.path.isdir(directory):
+        return entries
+    for name in os.listdir(directory):
+        if name.endswith(".part"):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        # 與工作輸出檔共用的硬連結不另外佔空間
+        entries.append((stat.st_mtime, stat.st_size if stat.st_nlink == 1 else 0, path))
+    return entries
+
+
+def _evict(directory, max_bytes):
+    """總容量超過上限時，從最久未使用的檔案開始刪除"""
+    entries = _entries(directory)
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def list_entries():
+    """回傳解碼快取與結果快取的所有檔案 [(最後使用時間, 大小, 路徑)]，供暫存空間清理計入容量與淘汰"""
+    with _lock:
+        return _entries(PCM_DIR) + _entries(RESULTS_DIR)
+
+
+def remove_entry(path):
+    """刪除一個快取檔，回傳是否已刪除"""
+    with _lock:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return not os.path.exists(path)
+
+
+def lookup_result(key, ext):
+    """查詢結果快取，命中時回傳快取檔路徑"""
+    path = os.path.join(RESULTS_DIR, key + ext)
+    with _lock:
+        return path if _touch(path) else None
+
+
+def store_result(key, ext, output_path, max_mb):
+    """將輸出檔存入結果快取 (同一磁碟時使用硬連結，不額外佔空間)"""
+    with _lock:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, key + ext)
+        tmp_path = path + ".part"
+        try:
+            os.link(output_path, tmp_path)
+        except OSError:
+            shutil.copyfile(output_path, tmp_path)
+        os.replace(tmp_path, path)
+        _evict(RESULTS_DIR, max_mb * 1024 * 1024)
+
+
+def copy_result(cached_path, output_path):
+    """將快取結果放到工作資料夾 (優先使用硬連結)"""
+    try:
+        os.link(cached_path, output_path)
+    except OSError:
+        shutil.copyfile(cached_path, output_path)
+
+
+def pcm_cache_path(input_hash, sr, layout=None):
+    """回傳解碼後 PCM 的快取路徑 (檔案不一定存在)；layout 為每條音軌的聲道數，單聲道時省略"""
+    os.makedirs(PCM_DIR, exist_ok=True)
+    suffix = "" if not layout or list(layout) == [1] else "_" + "-".join(str(c) for c in layout) + "ch"
+    return os.path.join(PCM_DIR, f"{input_hash}_{sr}{suffix}.f32")
+
+
+def touch_pcm(path):
+    with _lock:
+        return _touch(path)
+
+
+def evict_pcm(max_mb):
+    with _lock:
+        if os.path.isdir(PCM_DIR):
+            _evict(PCM_DIR, max_mb * 1024 * 1024)
+
+
+def purge_input(input_hash, cache_keys=()):
+    """刪除某個上傳檔的解碼快取與指定的結果快取 (含預覽版本)，使用者清除工作時呼叫"""
+    targets = ((PCM_DIR, (input_hash + "_",)), (RESULTS_DIR, tuple(key for key in cache_keys if key)))
+    with _lock:
+        for directory, prefixes in targets:
+            if not prefixes or not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.startswith(prefixes):
+                    try:
+                        os.remove(os.path.join(directory, name))
+                    except OSError:
+                        pass
@@ -0,0 +1,181 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import datetime
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from denoise_engine import (
+    init_model, BACKENDS, DEFAULT_BACKEND, DEFAULT_CHUNK_SEC, DEFAULT_CONTEXT_SEC, DEFAULT_OVERLAP_SEC
+)
+from denoise_pipeline import process_file, output_name_for
+from denoise_metrics import summarize
+
+# ================= 🗂️ 命令列批次降噪 =================
+# 用法：python -m denoise_cli 錄音資料夾/ "其他/**/*.mp4" -o 輸出資料夾 --atten 40 --workers 2
+SUPPORTED_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".wav", ".mp3", ".m4a", ".aac", ".flac")
+
+_print_lock = threading.Lock()
+
+
+def log(message):
+    with _print_lock:
+        print(message, file=sys.stderr, flush=True)
+
+
+def _glob_root(pattern):
+    """萬用字元中不含 * ? [ 的開頭目錄 (例如 archive/**/*.wav 為 archive)，作為輸出子目錄結構的起點"""
+    parts = []
+    for part in os.path.normpath(pattern).split(os.sep)[:-1]:
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return os.sep.join(parts) or (os.sep if os.path.isabs(pattern) else ".")
+
+
+def collect_inputs(patterns, recursive=False):
+    """展開資料夾、萬用字元與單一檔案，回傳 (來源檔, 相對於來源根目錄的路徑) 清單 (同一個檔案只列一次)"""
+    inputs = []
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            walker = os.walk(pattern) if recursive else [(pattern, [], os.listdir(pattern))]
+            for root, _, names in walker:
+                for name in sorted(names):
+                    path = os.path.join(root, name)
+                    if os.path.isfile(path) and name.lower().endswith(SUPPORTED_EXTENSIONS):
+                        inputs.append((path, os.path.relpath(path, pattern)))
+        else:
+            matches = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+            root = _glob_root(pattern)
+            for path in matches:
+                if os.path.isfile(path) and path.lower().endswith(SUPPORTED_EXTENSIONS):
+                    inputs.append((path, os.path.relpath(path, root)))
+                elif not os.path.exists(path):
+                    log(f"⚠️ 找不到輸入：{path}")
+    unique = []
+    for path, rel_path in inputs:
+        if os.path.realpath(path) not in seen:
+            seen.add(os.path.realpath(path))
+            unique.append((path, rel_path))
+    return unique
+
+
+def output_path_for(rel_path, args):
+    output_name, _ = output_name_for(os.path.basename(rel_path), args.atten)
+    return os.path.join(args.output_dir, os.path.dirname(rel_path), output_name)
+
+
+def find_conflicts(inputs, args):
+    """回傳會寫到同一個輸出檔的來源檔 {輸出路徑: [來源檔, ...]}"""
+    targets = {}
+    for path, rel_path in inputs:
+        targets.setdefault(os.path.normpath(output_path_for(rel_path, args)), []).append(path)
+    return {output: paths for output, paths in targets.items() if len(paths) > 1}
+
+
+def run_one(input_path, rel_path, args, model, df_state):
+    """處理單一檔案並回傳摘要紀錄；已存在的輸出預設略過"""
+    output_path = output_path_for(rel_path, args)
+    record = {"input": input_path, "output": output_path, "status": "done", "duration_sec": 0.0, "error": None,
+              "stages": {}, "skipped_ratio": None}
+
+    if os.path.exists(output_path) and not args.overwrite:
+        record["status"] = "skipped"
+        log(f"⏭️ 已存在，略過：{output_path}")
+        return record
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    start_time = time.time()
+    spans = []
+    try:
+        stats = process_file(input_path, output_path, args.atten, model, df_state,
+                             chunk_sec=args.chunk_sec, context_sec=args.context_sec,
+                             overlap_sec=args.overlap_sec, batch_size=args.batch_size, spans=spans,
+                             skip_silence=args.skip_silence,
+                             keep_channels=args.keep_channels or args.all_streams, all_streams=args.all_streams)
+        if stats.get("total_samples"):
+            record["skipped_ratio"] = round(stats["skipped_samples"] / stats["total_samples"], 4)
+        log(f"✅ 完成：{output_path}")
+    except subprocess.CalledProcessError as e:
+        record["status"] = "failed"
+        record["error"] = "FFmpeg 錯誤: " + (e.stderr.decode("utf-8", errors="ignore") if e.stderr else "無詳細錯誤")
+        log(f"❌ 失敗：{input_path}\n{record['error']}")
+    except Exception as e:
+        record["status"] = "failed"
+        record["error"] = f"發生錯誤: {str(e)}"
+        log(f"❌ 失敗：{input_path}\n{record['error']}")
+    record["duration_sec"] = round(time.time() - start_time, 1)
+    # 各階段耗時彙總 (每段降噪合計為 enhance)，方便找出批次處理的瓶頸
+    record["stages"] = summarize(spans)
+    return record
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m denoise_cli", description="Suyang! 族語影音降噪工具 — 命令列批次處理")
+    parser.add_argument("inputs", nargs="+", help="輸入檔案、資料夾或萬用字元 (例如 \"archive/**/*.wav\")")
+    parser.add_argument("-o", "--output-dir", required=True, help="輸出資料夾 (資料夾輸入會保留子目錄結構)")
+    parser.add_argument("--atten", type=int, default=40, help="降噪強度 dB (預設 40)")
+    parser.add_argument("--workers", type=int, default=1, help="同時處理的檔案數，共用同一個已載入的模型 (預設 1)")
+    parser.add_argument("-r", "--recursive", action="store_true", help="資料夾輸入時包含所有子資料夾")
+    parser.add_argument("--overwrite", action="store_true", help="重新處理已存在的輸出 (預設略過)")
+    parser.add_argument("--summary", help="處理摘要 JSON 的輸出路徑 (預設為輸出資料夾下的 denoise_summary.json)")
+    parser.add_argument("--chunk-sec", type=float, default=DEFAULT_CHUNK_SEC, help="串流引擎分段長度 (秒)")
+    parser.add_argument("--context-sec", type=float, default=DEFAULT_CONTEXT_SEC, help="每段前方的暖機上下文 (秒)")
+    parser.add_argument("--overlap-sec", type=float, default=DEFAULT_OVERLAP_SEC, help="段落交界交叉淡化長度 (秒)")
+    parser.add_argument("--batch-size", type=int, default=0, help="一次前向運算疊幾段視窗 (0 = 自動)")
+    parser.add_argument("--keep-channels", action="store_true",
+                        help="保留原始聲道 (立體聲 / 多聲道) 一次批次降噪，預設混成單聲道；純音檔最多保留為立體聲")
+    parser.add_argument("--all-streams", action="store_true", help="保留影片的所有音軌 (隱含 --keep-channels)")
+    parser.add_argument("--skip-silence", action="store_true",
+                        help="明顯比說話聲小的靜音段落不送進模型、直接衰減以加快處理 (預設所有段落都送進模型)")
+    parser.add_argument("--backend", choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help="推論後端：torch (原始模型)、int8 (動態量化)、torchscript (凍結靜態圖)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    inputs = collect_inputs(args.inputs, recursive=args.recursive)
+    if not inputs:
+        log("找不到任何支援的影音檔案。")
+        return 1
+    # 不同來源對應到同一個輸出檔時 (例如不同子資料夾的同名檔案) 直接停止，避免互相覆寫或被誤判為已存在而略過
+    conflicts = find_conflicts(inputs, args)
+    if conflicts:
+        for output, paths in conflicts.items():
+            log(f"❌ 多個輸入會寫到同一個輸出檔 {output}：{', '.join(paths)}")
+        return 2
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # CPU 核心平均分給同時處理的檔案，避免執行緒超額使用
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // max(1, args.workers)))
+    log(f"🧠 載入模型中... (共 {len(inputs)} 個檔案，{args.workers} 個同時處理，推論後端 {args.backend})")
+    model, df_state = init_model(args.backend)
+
+    started_at = datetime.datetime.now().astimezone().isoformat(timespec="seconds")
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        records = list(executor.map(lambda item: run_one(item[0], item[1], args, model, df_state), inputs))
+
+    counts = {status: sum(1 for r in records if r["status"] == status) for status in ("done", "skipped", "failed")}
+    summary = {
+        "started_at": started_at,
+        "finished_at": datetime.datetime.now().astimezone().isoformat(timespec="seconds"),
+        "atten_lim_db": args.atten,
+        "backend": args.backend,
+        "counts": counts,
+        "files": records,
+    }
+    summary_path = args.summary or os.path.join(args.output_dir, "denoise_summary.json")
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    log(f"📊 完成 {counts['done']}、略過 {counts['skipped']}、失敗 {counts['failed']}，摘要：{summary_path}")
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,420 @@
+import os
+import math
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import torch
+import torch.nn.functional as F
+
+# ================= 🩹 系統補丁 =================
+def apply_patches():
+    try:
+        import df.utils
+        df.utils.get_git_root = lambda: "."
+        df.utils.get_commit_hash = lambda: "web_v1"
+        df.utils.get_branch_name = lambda: "master"
+    except ImportError:
+        pass
+
+# 模型版本：init_df 預設載入的預訓練模型，亦作為結果快取鍵的一部分 (換模型時舊快取自動失效)
+MODEL_VERSION = "DeepFilterNet3"
+
+# ================= ⚡ 推論後端 =================
+# torch：原始全精度模型 (參考後端)
+# int8：Linear / GRU 權重動態量化為 int8，CPU 上矩陣運算較快
+# torchscript：追蹤並凍結成靜態圖，以 optimize_for_inference 融合運算子後執行
+BACKENDS = ("torch", "int8", "torchscript")
+DEFAULT_BACKEND = "torch"
+# 與參考後端比對的容許誤差：輸出的信噪比 (dB) 低於此值時拒絕啟用該後端
+BACKEND_MIN_SNR_DB = 30.0
+# 比對用的測試音訊長度 (秒)
+VERIFY_SEC = 3.0
+
+
+def model_version(backend=DEFAULT_BACKEND):
+    """結果快取使用的模型版本字串 (非參考後端的輸出略有差異，因此分開快取)"""
+    return MODEL_VERSION if backend == DEFAULT_BACKEND else f"{MODEL_VERSION}-{backend}"
+
+
+def _verify_signal(df_state, seconds=VERIFY_SEC):
+    """固定亂數種子產生的雙聲道測試音訊 (諧波 + 噪音)，雙聲道可同時驗證批次維度"""
+    sr = df_state.sr()
+    generator = torch.Generator().manual_seed(0)
+    t = torch.arange(int(seconds * sr), dtype=torch.float32) / sr
+    tone = 0.3 * torch.sin(2 * math.pi * 220 * t) * (0.5 + 0.5 * torch.sin(2 * math.pi * 3 * t))
+    noise = 0.1 * torch.randn(2, t.shape[0], generator=generator)
+    return tone + noise
+
+
+def build_backend(model, df_state, backend):
+    """由參考模型建立指定的推論後端 (回傳可直接交給 enhance() 的模型)"""
+    if backend == "torch":
+        return model
+    if backend == "int8":
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear, torch.nn.GRU}, dtype=torch.qint8)
+    if backend == "torchscript":
+        from df.enhance import df_features, ModelParams
+        nb_df = getattr(model, "nb_df", ModelParams().nb_df)
+        spec, erb_feat, spec_feat = df_features(_verify_signal(df_state, seconds=1.0), df_state, nb_df)
+        with torch.no_grad():
+            traced = torch.jit.trace(model.eval(), (spec.clone(), erb_feat, spec_feat), check_trace=False)
+        return torch.jit.optimize_for_inference(traced.eval())
+    raise RuntimeError(f"不支援的推論後端: {backend} (可用: {', '.join(BACKENDS)})")
+
+
+def verify_backend(reference, candidate, df_state, min_snr_db=BACKEND_MIN_SNR_DB):
+    """以同一段測試音訊比對候選後端與參考後端的輸出，信噪比低於容許值時拋出 RuntimeError，否則回傳信噪比"""
+    from df.enhance import enhance
+
+    audio = _verify_signal(df_state)
+    expected = enhance(reference, df_state, audio, atten_lim_db=None)
+    actual = enhance(candidate, df_state, audio, atten_lim_db=None)
+    error = torch.sum((actual - expected) ** 2)
+    snr_db = float(10 * torch.log10(torch.sum(expected ** 2) / error)) if error > 0 else float("inf")
+    if snr_db < min_snr_db:
+        raise RuntimeError(f"推論後端輸出與參考模型差異過大 (SNR {snr_db:.1f} dB < {min_snr_db:.0f} dB)")
+    return snr_db
+
+
+def init_model(backend=DEFAULT_BACKEND):
+    """載入 DeepFilterNet 模型與 DF 狀態 (網頁快取與背景工作行程共用)
+
+    backend 不是參考後端時，會先建立加速後端並與參考模型比對輸出，通過容許誤差檢查才會使用。
+    """
+    apply_patches()
+    from df.enhance import init_df
+    model, df_state, _ = init_df(model_base_dir=None, default_model=MODEL_VERSION)
+    if backend != DEFAULT_BACKEND:
+        fast_model = build_backend(model, df_state, backend)
+        verify_backend(model, fast_model, df_state)
+        model = fast_model
+    return model, df_state
+
+
+# ================= 🎛️ 串流降噪引擎 =================
+# 預設參數：每段推進 10 秒、前方保留 1 秒暖機上下文、段落交界 0.25 秒交叉淡化
+DEFAULT_CHUNK_SEC = 10.0
+DEFAULT_CONTEXT_SEC = 1.0
+DEFAULT_OVERLAP_SEC = 0.25
+
+# 批次推論：實測 DeepFilterNet3 每個輸入取樣點約需 140 bytes 運算記憶體，取 160 保留餘裕
+BYTES_PER_SAMPLE = 160
+# 自動批次最多只佔用可用記憶體的 1/4，且不超過此上限 (再大對 CPU 吞吐已無幫助)
+MAX_AUTO_BATCH = 8
+
+# 平行模式：每個工作行程一次負責的分片長度 (秒)
+DEFAULT_SHARD_SEC = 60.0
+
+# 靜音略過：以 100ms 音框分頻帶估計背景噪音底 (各頻帶近 60 秒音框能量的第 10 百分位)，
+# 整段視窗中任一頻帶高於該頻帶噪音底 6dB 的音框不到 1% 時視為沒有人聲。
+# 分頻帶判斷讓集中在低頻的語音在寬頻噪音中 (整體 SNR 低於 0dB) 仍能被偵測到
+SKIP_FRAME_SEC = 0.1
+SKIP_HISTORY_SEC = 60.0
+SKIP_FLOOR_QUANTILE = 0.1
+SKIP_MARGIN_DB = 6.0
+SKIP_BAND_EDGES_HZ = (100, 300, 800, 2000, 5000)
+# 低於此音量的頻帶能量一律視為靜音 (例如數位靜音或極輕微的底噪)
+SKIP_ABS_SILENCE_DB = -60.0
+SKIP_MAX_ACTIVE_RATIO = 0.01
+# 此外視窗音量必須同時低於絕對上限，且比目前為止最大聲的視窗低至少 SKIP_MIN_DROP_DB 才會略過：
+# 整段都是穩定聲音 (持續音、低 SNR 錄音) 或音量都很小的檔案不會被整段略過，
+# 略過的段落與模型輸出的差異至少比節目音量低 SKIP_MIN_DROP_DB 再加上降噪強度上限
+SKIP_MAX_LEVEL_DB = -40.0
+SKIP_MIN_DROP_DB = 30.0
+
+
+def _crossfade_curves(length):
+    """產生總和恆為 1 的升餘弦淡入 / 淡出曲線 (同源訊號適用線性疊加)"""
+    if length <= 0:
+        return None, None
+    t = torch.arange(length, dtype=torch.float32) / length
+    fade_in = 0.5 - 0.5 * torch.cos(math.pi * t)
+    return fade_in, 1.0 - fade_in
+
+
+def available_memory():
+    """讀取系統可用記憶體 (bytes)，無法取得時回傳 None"""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except Exception:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        return None
+
+
+def auto_batch_size(window_samples, channels=1):
+    """依可用記憶體自動決定一次前向運算要疊幾段視窗"""
+    available = available_memory()
+    if not available:
+        return 1
+    per_window = window_samples * channels * BYTES_PER_SAMPLE
+    return int(max(1, min(MAX_AUTO_BATCH, (available // 4) // per_window)))
+
+
+def _make_stitcher(overlap):
+    """建立依序接合視窗輸出的函式：與上一段的重疊區交叉淡化，並保留本段尾端等待下一段"""
+    fade_in, fade_out = _crossfade_curves(overlap)
+    prev_tail = None  # 上一段重疊區的降噪結果，等待與下一段交叉淡化
+
+    def stitch(out, seg_len, is_last):
+        nonlocal prev_tail
+        if prev_tail is not None:
+            n = prev_tail.shape[-1]
+            out[:, :n] = prev_tail * fade_out[:n] + out[:, :n] * fade_in[:n]
+            prev_tail = None
+        if is_last:
+            return out
+        if overlap:
+            prev_tail = out[:, seg_len:]
+        return out[:, :seg_len]
+
+    return stitch
+
+
+def _make_silence_detector(sr, guard):
+    """建立逐段判斷是否為靜音的函式：is_silent(audio, history_len)，history_len 為計入噪音底估計的樣本數
+
+    頭尾 guard 個樣本會與相鄰視窗交叉淡化，只要其中有任何音框高於門檻就不略過，避免削弱語音的開頭或結尾。
+    """
+    frame = max(int(SKIP_FRAME_SEC * sr), 1)
+    guard_frames = -(-guard // frame)
+    history = deque(maxlen=max(int(SKIP_HISTORY_SEC / SKIP_FRAME_SEC), 1))
+    window = torch.hann_window(frame)
+    freqs = torch.fft.rfftfreq(frame, 1 / sr)
+    bands = [((freqs >= low) & (freqs < high)).float()
+             for low, high in zip(SKIP_BAND_EDGES_HZ, SKIP_BAND_EDGES_HZ[1:]) if low < sr / 2]
+    band_matrix = torch.stack(bands, dim=1)  # [頻率格數, 頻帶數]
+    # 換算成各頻帶對音框均方值的貢獻，與整體音量同一個 dB 尺度
+    scale = 2 / (frame * float(torch.sum(window ** 2)))
+    loudest_db = -float("inf")
+
+    def is_silent(audio, history_len):
+        nonlocal loudest_db
+        count = audio.shape[-1] // frame
+        if count == 0:
+            return False
+        level_db = 10 * math.log10(float(torch.mean(audio ** 2)) + 1e-10)
+        loudest_db = max(loudest_db, level_db)
+        frames = audio[:, :count * frame].reshape(audio.shape[0], count, frame)
+        power = torch.mean(torch.fft.rfft(frames * window).abs() ** 2, dim=0)
+        band_db = 10 * torch.log10(power @ band_matrix * scale + 1e-10)  # [音框數, 頻帶數]
+        history.extend(band_db[:max(history_len // frame, 1)])
+        floor = torch.quantile(torch.stack(list(history)), SKIP_FLOOR_QUANTILE, dim=0)
+        threshold = torch.clamp(floor + SKIP_MARGIN_DB, min=SKIP_ABS_SILENCE_DB)
+        active = torch.any(band_db > threshold, dim=1)
+        if guard_frames and (bool(active[:guard_frames].any()) or bool(active[-guard_frames:].any())):
+            return False
+        if float(torch.mean(active.float())) >= SKIP_MAX_ACTIVE_RATIO:
+            return False
+        return level_db <= SKIP_MAX_LEVEL_DB and level_db <= loudest_db - SKIP_MIN_DROP_DB
+
+    return is_silent
+
+
+def _attenuation_gain(atten_lim_db):
+    """降噪強度上限對應的線性增益 (模型對純噪音最多只會衰減到這個程度；不設限時為 0)"""
+    return 10 ** (-abs(atten_lim_db) / 20) if atten_lim_db else 0.0
+
+
+def enhance_batch(model, df_state, windows, atten_lim_db):
+    """將多段 [C, T] 視窗補零至等長後疊成一個 batch，一次前向運算後再拆回並裁切"""
+    from df.enhance import enhance
+
+    if len(windows) == 1:
+        return [enhance(model, df_state, windows[0], atten_lim_db=atten_lim_db)]
+
+    lengths = [w.shape[-1] for w in windows]
+    channels = windows[0].shape[0]
+    max_len = max(lengths)
+    batch = torch.cat([F.pad(w, (0, max_len - n)) for w, n in zip(windows, lengths)], dim=0)
+    out = enhance(model, df_state, batch, atten_lim_db=atten_lim_db)
+    return [out[i * channels:(i + 1) * channels, :n] for i, n in enumerate(lengths)]
+
+
+def enhance_strengths(model, df_state, audio, atten_levels):
+    """同一段音訊只做一次前向運算，產生多種降噪強度的結果 ({強度: [C, T] 張量})
+
+    enhance() 的強度限制是在頻譜上做「lim × 原始 + (1 - lim) × 降噪」，而 STFT / ISTFT 為線性且可完美重建，
+    因此等同於在時域上將原始音訊與不設限的降噪結果線性混合 (實測誤差 < 1e-7)。
+    """
+    from df.enhance import enhance
+
+    full = enhance(model, df_state, audio, atten_lim_db=None)
+    results = {}
+    for atten_lim_db in atten_levels:
+        lim = _attenuation_gain(atten_lim_db)
+        results[atten_lim_db] = audio * lim + full * (1 - lim)
+    return results
+
+
+def _iter_windows(blocks, hop, context, overlap, history=None):
+    """將輸入塊重新切成視窗，回傳 (視窗, 暖機長度, 本段長度, 是否為最後一段)
+
+    視窗只取自原始輸入，彼此獨立，因此可以任意分批送進模型。
+    history 為 blocks 之前的原始音訊 (從檔案中途開始時使用)，作為第一段的暖機上下文。
+    """
+    pending = None  # 尚未處理的輸入
+    # 已處理段落尾端的原始音訊，供下一段暖機
+    history = history[:, -context:] if history is not None and context and history.shape[-1] else None
+
+    def take(seg_len, is_last):
+        nonlocal history
+        window = pending if is_last else pending[:, :seg_len + overlap]
+        ctx_len = 0 if history is None else history.shape[-1]
+        if ctx_len:
+            window = torch.cat([history, window], dim=-1)
+        if context:
+            history = window[:, :ctx_len + seg_len][:, -context:]
+        return window, ctx_len, seg_len, is_last
+
+    for block in blocks:
+        pending = block if pending is None else torch.cat([pending, block], dim=-1)
+        while pending.shape[-1] >= hop + overlap:
+            yield take(hop, is_last=False)
+            pending = pending[:, hop:]
+
+    if pending is not None and pending.shape[-1] > 0:
+        yield take(pending.shape[-1], is_last=True)
+
+
+def enhance_stream(model, df_state, blocks, atten_lim_db, chunk_sec=DEFAULT_CHUNK_SEC,
+                   context_sec=DEFAULT_CONTEXT_SEC, overlap_sec=DEFAULT_OVERLAP_SEC, batch_size=1,
+                   skip_silence=False, stats=None, history=None, prime=False):
+    """串流降噪：逐塊讀入 [C, T] 音訊，以重疊視窗加交叉淡化方式輸出降噪結果
+
+    每個視窗 = 前方暖機上下文 + 本段 (chunk_sec) + 後方重疊區 (overlap_sec)。
+    暖機區讓模型的遞迴狀態在本段開始前就已收斂，輸出時捨棄；重疊區與下一段的開頭交叉淡化，
+    消除段落接縫。每累積 batch_size 段 (0 代表依記憶體自動決定) 就一次送進模型。
+    skip_silence 為 True 時，沒有人聲的視窗不送進模型，直接乘上降噪強度上限的增益，
+    與相鄰視窗的接縫同樣經過交叉淡化；stats 為 dict 時會累計 total_samples 與 skipped_samples。
+    輸出的總長度與輸入完全相同，可邊產生邊寫出。
+    從檔案中途續跑時，history 為 blocks 之前的原始音訊；prime 為 True 時第一段只用來重建與下一段
+    交叉淡化的重疊區，不輸出也不計入 stats (blocks 須從已完成的最後一段開頭開始)。
+    """
+    sr = df_state.sr()
+    hop = max(int(chunk_sec * sr), 1)
+    context = max(int(context_sec * sr), 0)
+    overlap = max(int(overlap_sec * sr), 0)
+    stitch = _make_stitcher(overlap)
+    is_silent = _make_silence_detector(sr, overlap) if skip_silence else None
+    gain = _attenuation_gain(atten_lim_db)
+    if stats is not None:
+        stats.setdefault("total_samples", 0)
+        stats.setdefault("skipped_samples", 0)
+
+    pending_windows = []  # (視窗, 暖機長度, 本段長度, 是否為最後一段, 是否略過, 是否只用來重建重疊區)
+
+    def flush():
+        model_windows = [w[0] for w in pending_windows if not w[4]]
+        outs = iter(enhance_batch(model, df_state, model_windows, atten_lim_db) if model_windows else [])
+        windows = list(pending_windows)
+        pending_windows.clear()
+        for window, ctx_len, seg_len, is_last, skipped, primer in windows:
+            out = window * gain if skipped else next(outs)
+            chunk = stitch(out[:, ctx_len:], seg_len, is_last)
+            if primer:
+                continue
+            # 統計在輸出該段時才累計，呼叫端每取得一段時 stats 都恰好涵蓋已輸出的部分
+            if stats is not None:
+                stats["total_samples"] += seg_len
+                stats["skipped_samples"] += seg_len if skipped else 0
+            yield chunk
+
+    for index, (window, ctx_len, seg_len, is_last) in enumerate(_iter_windows(blocks, hop, context, overlap, history)):
+        if batch_size <= 0:
+            batch_size = auto_batch_size(context + hop + overlap, channels=window.shape[0])
+        skipped = bool(is_silent) and is_silent(window[:, ctx_len:], seg_len)
+        pending_windows.append((window, ctx_len, seg_len, is_last, skipped, prime and index == 0))
+        model_count = sum(1 for w in pending_windows if not w[4])
+        # 累積滿一批才送進模型；前面沒有等待中的模型視窗時，略過的視窗立即輸出
+        if model_count >= batch_size or model_count == 0:
+            yield from flush()
+
+    if pending_windows:
+        yield from flush()
+
+
+# ================= 🧵 多行程平行處理 =================
+_worker_model = None
+
+
+def _init_worker(num_threads, backend):
+    """工作行程初始化：限制執行緒數避免超額使用 CPU，並只載入一次模型"""
+    global _worker_model
+    torch.set_num_threads(num_threads)
+    _worker_model = init_model(backend)
+
+
+def _enhance_shard(window, atten_lim_db, chunk_sec, context_sec, overlap_sec, batch_size, skip_silence):
+    """在工作行程中以串流引擎處理一個分片 (以 numpy 陣列往返，避免共享記憶體 handle)
+
+    回傳 (降噪結果, 略過的靜音樣本數)。
+    """
+    model, df_state = _worker_model
+    stats = {}
+    outs = enhance_stream(model, df_state, [torch.from_numpy(window)], atten_lim_db,
+                          chunk_sec=chunk_sec, context_sec=context_sec,
+                          overlap_sec=overlap_sec, batch_size=batch_size,
+                          skip_silence=skip_silence, stats=stats)
+    return torch.cat(list(outs), dim=-1).numpy(), stats["skipped_samples"]
+
+
+def create_worker_pool(workers, backend=DEFAULT_BACKEND, threads=0):
+    """建立平行降噪用的行程池，threads 個執行緒 (0 = 全部核心) 平均分給每個工作行程"""
+    threads = max(1, (threads if threads > 0 else (os.cpu_count() or 1)) // workers)
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_worker, initargs=(threads, backend))
+
+
+def enhance_parallel(pool, df_state, blocks, atten_lim_db, shard_sec=DEFAULT_SHARD_SEC,
+                     chunk_sec=DEFAULT_CHUNK_SEC, context_sec=DEFAULT_CONTEXT_SEC,
+                     overlap_sec=DEFAULT_OVERLAP_SEC, batch_size=1, max_pending=4,
+                     skip_silence=False, stats=None, history=None, prime=False):
+    """平行降噪：將音訊切成分片交給行程池，依原始順序接合後逐片輸出
+
+    分片的切法與 enhance_stream 的視窗相同 (前方暖機上下文 + 後方交叉淡化重疊區)，
+    只是每片更長，並在工作行程內再以串流引擎細分。同時最多只送出 max_pending 片，
+    讓記憶體用量不隨檔案長度增加。skip_silence、stats、history 與 prime 的意義與 enhance_stream 相同
+    (prime 時重新計算的是一整個分片)。
+    """
+    sr = df_state.sr()
+    shard = max(int(shard_sec * sr), 1)
+    context = max(int(context_sec * sr), 0)
+    overlap = max(int(overlap_sec * sr), 0)
+    stitch = _make_stitcher(overlap)
+    futures = deque()
+    if stats is not None:
+        stats.setdefault("total_samples", 0)
+        stats.setdefault("skipped_samples", 0)
+
+    def collect():
+        future, ctx_len, seg_len, is_last, primer = futures.popleft()
+        out, skipped = future.result()
+        chunk = stitch(torch.from_numpy(out)[:, ctx_len:], seg_len, is_last)
+        if primer:
+            return None
+        if stats is not None:
+            # 分片內的統計包含暖機區與重疊區，依本段長度所佔比例換算
+            total = out.shape[-1]
+            stats["total_samples"] += seg_len
+            stats["skipped_samples"] += int(skipped * seg_len / total) if total else 0
+        return chunk
+
+    for index, (window, ctx_len, seg_len, is_last) in enumerate(_iter_windows(blocks, shard, context, overlap, history)):
+        future = pool.submit(_enhance_shard, window.numpy(), atten_lim_db,
+                             chunk_sec, context_sec, overlap_sec, batch_size, skip_silence)
+        futures.append((future, ctx_len, seg_len, is_last, prime and index == 0))
+        if len(futures) >= max_pending:
+            chunk = collect()
+            if chunk is not None:
+                yield chunk
+
+    while futures:
+        chunk = collect()
+        if chunk is not None:
+            yield chunk
@@ -0,0 +1,148 @@
+import os
+import re
+import time
+import uuid
+import mimetypes
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# ================= 📤 串流檔案伺服器 =================
+# 成果檔與預覽檔直接從磁碟分段傳送 (支援 HTTP Range，可拖曳播放進度、續傳下載)，
+# 不經過 Streamlit，也不會把整個檔案讀進 Python 記憶體。
+# 網址格式：/files/<工作編號>/<download|preview>，由呼叫端提供的 resolver 決定實際檔案。
+COPY_CHUNK = 1 << 20
+KIND_DOWNLOAD = "download"
+KIND_PREVIEW = "preview"
+# 非工作檔案 (例如管理員匯出的使用數據) 以隨機代碼取代工作編號，代碼逾期後失效：/files/<代碼>/export
+KIND_EXPORT = "export"
+SHARE_TTL_SEC = 600
+
+_shared_lock = threading.Lock()
+_shared = {}  # 代碼 → (檔案路徑, 下載檔名, 到期時間)
+
+_RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+def _content_disposition(filename, inline):
+    """同時提供 ASCII 檔名與 RFC 5987 編碼的原始檔名 (中文檔名在各瀏覽器都能正確顯示)"""
+    fallback = filename.encode("ascii", errors="ignore").decode() or "download"
+    fallback = fallback.replace('"', "")
+    disposition = "inline" if inline else "attachment"
+    return f"{disposition}; filename=\"{fallback}\"; filename*=UTF-8''{urllib.parse.quote(filename)}"
+
+
+def _parse_range(header, size):
+    """解析單一 Range 標頭，回傳 (起點, 終點)；格式錯誤或超出範圍時回傳 None"""
+    match = _RANGE_RE.match(header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    if match.group(1):
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    else:
+        # bytes=-N 代表最後 N 個位元組
+        start = max(0, size - int(match.group(2)))
+        end = size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+def make_handler(resolver):
+    """建立 HTTP 處理類別；resolver(job_id, kind) 回傳 (檔案路徑, 下載檔名, 是否內嵌播放) 或 None"""
+
+    class FileHandler(BaseHTTPRequestHandler):
+        # 保持連線：播放器拖曳進度時會連續發出多個 Range 請求
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self._serve(send_body=True)
+
+        def do_HEAD(self):
+            self._serve(send_body=False)
+
+        def log_message(self, *args):
+            pass
+
+        def _serve(self, send_body):
+            parts = urllib.parse.urlparse(self.path).path.strip("/").split("/")
+            target = resolver(parts[1], parts[2]) if len(parts) == 3 and parts[0] == "files" else None
+            if not target or not os.path.isfile(target[0]):
+                self.send_error(404)
+                return
+            path, filename, inline = target
+            size = os.path.getsize(path)
+
+            start, end, status = 0, size - 1, 200
+            if self.headers.get("Range") and size:
+                byte_range = _parse_range(self.headers["Range"], size)
+                if byte_range is None:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                (start, end), status = byte_range, 206
+
+            self.send_response(status)
+            self.send_header("Content-Type", mimetypes.guess_type(filename)[0] or "application/octet-stream")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Disposition", _content_disposition(filename, inline))
+            self.send_header("Cache-Control", "private, max-age=3600")
+            if status == 206:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.end_headers()
+            if not send_body:
+                return
+
+            with open(path, "rb") as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = f.read(min(COPY_CHUNK, remaining))
+                    if not chunk:
+                        # 檔案在傳送途中被截短，已送出的長度與標頭不符，不可再沿用此連線
+                        self.close_connection = True
+                        break
+                    try:
+                        self.wfile.write(chunk)
+                    except (BrokenPipeError, ConnectionResetError):
+                        # 播放器拖曳進度時常會中途關閉連線，屬正常情況
+                        return
+                    remaining -= len(chunk)
+
+    return FileHandler
+
+
+def start_file_server(resolver, host="127.0.0.1", port=8502):
+    """在背景執行緒啟動檔案伺服器 (每個連線一個執行緒)，回傳伺服器物件；連接埠被占用時拋出 OSError"""
+    server = ThreadingHTTPServer((host, port), make_handler(resolver))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="denoise-file-server", daemon=True).start()
+    return server
+
+
+def share_file(path, filename, ttl_sec=SHARE_TTL_SEC):
+    """登記一個可由檔案伺服器下載的檔案，回傳隨機代碼 (於 ttl_sec 秒後失效)"""
+    token = uuid.uuid4().hex
+    now = time.time()
+    with _shared_lock:
+        for expired in [key for key, (_, _, expires_at) in _shared.items() if expires_at < now]:
+            del _shared[expired]
+        _shared[token] = (path, filename, now + ttl_sec)
+    return token
+
+
+def shared_file(token):
+    """依代碼取得 (檔案路徑, 下載檔名)，不存在或已逾期時回傳 None"""
+    with _shared_lock:
+        entry = _shared.get(token)
+    if not entry or entry[2] < time.time():
+        return None
+    return entry[0], entry[1]
+
+
+def file_url(base_url, job_id, kind):
+    return f"{base_url.rstrip('/')}/files/{job_id}/{kind}"
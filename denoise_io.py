@@ -0,0 +1,327 @@
+import os
+import json
+import tempfile
+import subprocess
+import threading
+import numpy as np
+import torch
+
+# ================= 🎞️ FFmpeg 串流輸入輸出 =================
+# 管線中一律使用 32-bit float PCM (pcm_f32le)，與模型的浮點輸入輸出直接對應
+PCM_FORMAT = "f32le"
+PCM_BYTES = 4
+
+
+def pcm_bytes(block):
+    """[C, T] 張量 → 交錯排列 ([T, C]) 的 float32 PCM 位元組"""
+    return block.to(torch.float32).T.contiguous().numpy().tobytes()
+
+
+def _start_ffmpeg(cmd, **kwargs):
+    """啟動 ffmpeg 子行程，並以背景執行緒收集 stderr，避免管線塞滿造成死結
+
+    回傳 (行程, finish)；finish(check=True) 會等待行程結束，失敗時拋出 CalledProcessError。
+    """
+    proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, **kwargs)
+    stderr_chunks = []
+    drain = threading.Thread(target=lambda: stderr_chunks.append(proc.stderr.read()), daemon=True)
+    drain.start()
+
+    def finish(check=True):
+        proc.wait()
+        drain.join()
+        if check and proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=b"".join(stderr_chunks))
+
+    return proc, finish
+
+
+# 上傳檔寫入磁碟時每次只讀取 8MB，記憶體用量與檔案大小無關
+UPLOAD_CHUNK = 8 << 20
+
+
+def spool_upload(source, output_path, sha=None, chunk_size=UPLOAD_CHUNK):
+    """將上傳檔 (任何具備 read 的檔案物件) 分段寫入磁碟，可同時更新雜湊；回傳寫入的位元組數"""
+    source.seek(0)
+    written = 0
+    with open(output_path, "wb") as f:
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            if sha is not None:
+                sha.update(chunk)
+            f.write(chunk)
+            written += len(chunk)
+    return written
+
+
+def probe_duration(input_path):
+    """以 ffprobe 讀取媒體長度 (秒)，無法判斷時回傳 None"""
+    cmd = [
+        "ffprobe", "-v", "error", "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1", input_path
+    ]
+    try:
+        result = subprocess.run(cmd, check=True, capture_output=True)
+        return float(result.stdout.decode().strip())
+    except Exception:
+        return None
+
+
+def probe_media(input_path):
+    """以 ffprobe 讀取容器格式、長度與第一條音軌的資訊
+
+    回傳 {"format", "duration", "audio", "audio_streams", "audio_channels", "has_video"}，其中 audio 為第一條音軌
+    ({"codec_name", "sample_rate", "channels"}，沒有音軌時為 None)，audio_channels 為每條音軌的聲道數。
+    檔案損毀或格式不支援時拋出 CalledProcessError。
+    """
+    cmd = [
+        "ffprobe", "-v", "error", "-show_entries",
+        "format=format_name,duration:stream=index,codec_type,codec_name,sample_rate,channels",
+        "-of", "json", input_path
+    ]
+    result = subprocess.run(cmd, check=True, capture_output=True)
+    data = json.loads(result.stdout.decode("utf-8", errors="ignore") or "{}")
+    streams = data.get("streams", [])
+    audio_streams = [stream for stream in streams if stream.get("codec_type") == "audio"]
+    audio = None
+    if audio_streams:
+        first = audio_streams[0]
+        audio = {
+            "codec_name": first.get("codec_name", ""),
+            "sample_rate": int(first.get("sample_rate") or 0),
+            "channels": int(first.get("channels") or 0),
+        }
+    try:
+        duration = float(data.get("format", {}).get("duration"))
+    except (TypeError, ValueError):
+        duration = None
+    return {
+        "format": data.get("format", {}).get("format_name", ""),
+        "duration": duration,
+        "audio": audio,
+        "audio_streams": len(audio_streams),
+        "audio_channels": [int(stream.get("channels") or 0) for stream in audio_streams],
+        "has_video": any(stream.get("codec_type") == "video" for stream in streams),
+    }
+
+
+# 純音檔輸出為 MP3，最多只能有兩個聲道
+MAX_AUDIO_ONLY_CHANNELS = 2
+
+
+def channel_layout(media, is_audio_only, keep_channels=False, all_streams=False):
+    """決定要處理的聲道配置，回傳每條輸出音軌的聲道數 (例如 [1]、[2]、[2, 1])
+
+    預設混成單聲道；keep_channels 為 True 時保留第一條音軌的所有聲道 (純音檔最多保留為立體聲)；
+    再加上 all_streams 時保留影片的所有音軌 (純音檔的輸出格式只有一條音軌，因此只取第一條)。
+    """
+    audio = media.get("audio") if media else None
+    if not audio or not keep_channels:
+        return [1]
+    if is_audio_only:
+        return [max(1, min(audio["channels"], MAX_AUDIO_ONLY_CHANNELS))]
+    counts = media.get("audio_channels") or [audio["channels"]]
+    if all_streams and len(counts) > 1 and all(counts):
+        return counts
+    return [max(audio["channels"], 1)]
+
+
+def is_direct_wav(media, sr, channels=1):
+    """已是模型取樣率、聲道數相同的 PCM WAV 時可直接讀取，不必經過 ffmpeg 解碼"""
+    audio = media.get("audio") if media else None
+    return bool(audio) and media["format"] == "wav" and audio["codec_name"].startswith("pcm_") \
+        and audio["sample_rate"] == sr and audio["channels"] == channels
+
+
+def read_wav_blocks(wav_path, block_samples, start=0):
+    """直接以 soundfile 逐塊讀取 PCM WAV，每次產生一個 [C, T] float32 張量 (start 為開始讀取的樣本位置)"""
+    import soundfile as sf
+
+    for block in sf.blocks(wav_path, blocksize=block_samples, dtype="float32", always_2d=True, start=start):
+        yield torch.from_numpy(block.T.copy())
+
+
+def _thread_args(threads):
+    """ffmpeg 的 -threads 參數 (0 = 由 ffmpeg 自動決定，通常會用滿所有核心)"""
+    return ["-threads", str(threads)] if threads and threads > 0 else []
+
+
+def decode_audio_blocks(input_path, sr, block_samples, channels=1, seek_sec=None, duration_sec=None, streams=1,
+                        threads=0):
+    """以 ffmpeg 將音軌解碼為 PCM 並從 stdout 逐塊讀出，每次產生一個 [C, T] 張量
+
+    不寫出任何暫存 WAV，記憶體用量只與 block_samples 有關。指定 seek_sec / duration_sec 時
+    只解碼該片段 (-ss 放在 -i 之前，由容器索引直接跳轉，不必從頭解碼)。
+    channels 為 1 或 2 時混成單聲道 / 立體聲；更多聲道時保留原始聲道 (須等於實際聲道數)。
+    streams 為 1 時只解碼第一條音軌；大於 1 時將前 streams 條音軌的聲道依序合併 (amerge)，
+    channels 須為這些音軌的聲道數總和。threads 為 ffmpeg 解碼可使用的執行緒數 (0 = 自動)。
+    """
+    seek = []
+    if seek_sec:
+        seek += ["-ss", f"{seek_sec:.3f}"]
+    if duration_sec:
+        seek += ["-t", f"{duration_sec:.3f}"]
+    if streams > 1:
+        inputs = "".join(f"[0:a:{i}]" for i in range(streams))
+        audio_map = ["-filter_complex", f"{inputs}amerge=inputs={streams}[a]", "-map", "[a]"]
+    else:
+        audio_map = ["-map", "0:a:0"]
+    # 單聲道 / 立體聲由 -ac 混音；更多聲道或合併多條音軌時不加 -ac，轉成 ffmpeg 的標準配置會依聲道名稱
+    # 重新混音 (例如 amerge 後的 FL FR FC → 2.1 會丟掉 FC)
+    downmix = ["-ac", str(channels)] if streams == 1 and channels <= 2 else []
+    cmd = ["ffmpeg"] + _thread_args(threads) + seek + ["-i", input_path] + audio_map + [
+        "-vn", "-f", PCM_FORMAT, "-acodec", "pcm_f32le", "-ar", str(sr)
+    ] + downmix + ["pipe:1", "-hide_banner", "-loglevel", "error"]
+    proc, finish = _start_ffmpeg(cmd, stdout=subprocess.PIPE)
+    frame_bytes = channels * PCM_BYTES
+    completed = False
+    try:
+        while True:
+            data = proc.stdout.read(block_samples * frame_bytes)
+            usable = len(data) - len(data) % frame_bytes
+            if usable <= 0:
+                break
+            frames = np.frombuffer(data[:usable], dtype=np.float32).reshape(-1, channels)
+            yield torch.from_numpy(frames.T.copy())
+        completed = True
+    finally:
+        if not completed:
+            proc.kill()
+        proc.stdout.close()
+        finish(check=completed)
+
+
+def _split_streams(layout):
+    """將合併後的聲道依 layout (每條音軌的聲道數) 拆回多條音軌的 filter_complex 參數"""
+    filters, maps, offset = [], [], 0
+    for i, count in enumerate(layout):
+        mapping = "|".join(f"c{c}=c{offset + c}" for c in range(count))
+        filters.append(f"[1:a]pan={count}c|{mapping}[a{i}]")
+        maps += ["-map", f"[a{i}]"]
+        offset += count
+    return ["-filter_complex", ";".join(filters)], maps
+
+
+def encode_audio(blocks, output_path, sr, video_path=None, channels=1, layout=None, threads=0):
+    """將 [C, T] 音訊塊直接寫進 ffmpeg 的 stdin 進行編碼 / 與原始影片封裝
+
+    video_path 為 None 時輸出 MP3 編碼音檔；否則複製原影片畫面，並以 AAC 編碼新的音軌。
+    layout 為每條音軌的聲道數 (例如 [2, 1])，有多條時將 channels 個聲道依序拆回多條音軌，
+    並沿用原始影片各音軌的語言等標籤；聲道配置 (立體聲、5.1 等) 依聲道數使用 ffmpeg 的標準配置。
+    threads 為 ffmpeg 可使用的執行緒數 (0 = 自動)。
+    """
+    pcm_input = ["-f", PCM_FORMAT, "-ar", str(sr), "-ac", str(channels), "-i", "pipe:0"]
+    # -threads 放在輸出檔之前才會套用到編碼器
+    output_args = _thread_args(threads) + [output_path, "-hide_banner", "-loglevel", "error"]
+    if video_path is None:
+        cmd = ["ffmpeg", "-y"] + pcm_input + ["-c:a", "libmp3lame", "-q:a", "2"] + output_args
+    elif layout and len(layout) > 1:
+        split, audio_maps = _split_streams(layout)
+        stream_tags = []
+        for i in range(len(layout)):
+            stream_tags += [f"-map_metadata:s:a:{i}", f"0:s:a:{i}"]
+        cmd = ["ffmpeg", "-y", "-i", video_path] + pcm_input + split + ["-map", "0:v:0"] + audio_maps + \
+            stream_tags + ["-c:v", "copy", "-c:a", "aac", "-shortest"] + output_args
+    else:
+        cmd = ["ffmpeg", "-y", "-i", video_path] + pcm_input + [
+            "-c:v", "copy", "-c:a", "aac", "-map", "0:v:0", "-map", "1:a:0", "-shortest"
+        ] + output_args
+
+    proc, finish = _start_ffmpeg(cmd, stdin=subprocess.PIPE)
+    completed = False
+    try:
+        for block in blocks:
+            proc.stdin.write(pcm_bytes(block))
+        completed = True
+    except BrokenPipeError:
+        # ffmpeg 已提前結束，真正的錯誤原因由 finish() 從 stderr 回報
+        completed = True
+    finally:
+        if not completed:
+            proc.kill()
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        finish(check=completed)
+
+
+# 預覽用的低位元率版本：影片最高 360p，音訊 64kbps
+PREVIEW_VIDEO_HEIGHT = 360
+PREVIEW_AUDIO_BITRATE = "64k"
+
+
+def preview_proxy_name(is_audio_only):
+    return "preview.mp3" if is_audio_only else "preview.mp4"
+
+
+def encode_preview_proxy(input_path, output_path, is_audio_only, threads=0):
+    """由成果檔轉出輕量的預覽版本 (網頁播放器使用，完整畫質的成果檔只在下載時傳送)"""
+    if is_audio_only:
+        codec = ["-vn", "-c:a", "libmp3lame", "-b:a", PREVIEW_AUDIO_BITRATE]
+    else:
+        codec = [
+            "-vf", f"scale=-2:'min({PREVIEW_VIDEO_HEIGHT},ih)'", "-c:v", "libx264", "-preset", "veryfast",
+            "-crf", "30", "-c:a", "aac", "-b:a", PREVIEW_AUDIO_BITRATE, "-movflags", "+faststart"
+        ]
+    cmd = ["ffmpeg", "-y", "-i", input_path] + codec + _thread_args(threads) + [
+        output_path, "-hide_banner", "-loglevel", "error"
+    ]
+    subprocess.run(cmd, check=True, capture_output=True)
+
+
+# ================= 💾 磁碟暫存 (兩階段音量正規化 / 解碼快取) =================
+def tee_pcm_blocks(blocks, pcm_path, partial_path=None):
+    """原樣轉送音訊塊，同時寫入 raw float32 檔；完整讀完才以原子方式產生檔案
+
+    每次寫入都使用各自的暫存檔 (同一個上傳檔的多個工作可同時寫入同一份快取)，中途失敗或未讀完時刪除暫存檔。
+    partial_path 不為 None 時改為接續寫入這個工作專屬的暫存檔 (不經緩衝，轉送出去的音訊塊都已寫到檔案)，
+    中斷時保留已寫入的部分，續跑時可從中讀回，不必重新解碼。
+    """
+    if partial_path:
+        tmp_path = partial_path
+        f = open(partial_path, "ab", buffering=0)
+    else:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(pcm_path) or ".", suffix=".part")
+        f = os.fdopen(fd, "wb")
+    try:
+        with f:
+            for block in blocks:
+                f.write(pcm_bytes(block))
+                yield block
+        if os.path.exists(pcm_path):
+            # 其他工作已先寫完同一份快取 (內容相同)，捨棄這份
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, pcm_path)
+    except BaseException:
+        if not partial_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def skip_samples(blocks, count):
+    """丟棄音訊塊串流的前 count 個樣本 (從頭解碼再捨棄到續跑位置，比 ffmpeg 跳轉更能精確到樣本)"""
+    for block in blocks:
+        if count >= block.shape[-1]:
+            count -= block.shape[-1]
+            continue
+        yield block[:, count:] if count else block
+        count = 0
+
+
+def read_pcm_blocks(pcm_path, block_samples, channels=1, gain=1.0, start=0, stop=None):
+    """以 numpy.memmap 逐塊讀回 raw float32 暫存檔並套用增益，每次只載入一塊到記憶體
+
+    start / stop 為要讀取的樣本範圍 (從中途續跑時使用)，預設讀取整個檔案。
+    """
+    if os.path.getsize(pcm_path) == 0:
+        return
+    frames = np.memmap(pcm_path, dtype=np.float32, mode="r").reshape(-1, channels)
+    stop = frames.shape[0] if stop is None else min(stop, frames.shape[0])
+    for offset in range(start, stop, block_samples):
+        block = np.array(frames[offset:min(offset + block_samples, stop)], dtype=np.float32) * np.float32(gain)
+        yield torch.from_numpy(block.T.copy())
+    del frames
@@ -0,0 +1,215 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import denoise_jobs
+import denoise_cache
+import denoise_files
+
+# ================= 🧹 暫存空間清理 =================
+# 工作資料夾 (上傳檔、降噪暫存、輸出檔)、試聽暫存、快取 (解碼快取、結果快取) 與使用數據匯出檔由背景執行緒定期清理：
+# 1. 逾期：已結束的工作與快取閒置超過保存期限即刪除 (失敗的工作期限較短，期限內仍可按「重試」續跑)
+# 2. 容量：總容量超過上限或磁碟剩餘空間不足時，從最久未使用的項目開始刪除 (執行中、排隊中的工作不會被刪除)
+# 送出新工作前也會先檢查一次，清理後空間仍不足時拒絕新工作。
+PREVIEW_PREFIX = "denoise_preview_"
+# 管理員匯出的使用數據 (含使用者名稱與檔名)：下載連結失效後即刪除
+EXPORT_PREFIX = "denoise_export_"
+# 剛完成或剛被查看過的項目不因容量不足而刪除，避免使用者正要下載時檔案消失
+MIN_IDLE_SEC = 300
+
+_lock = threading.Lock()
+_thread = None
+_ttl_sec = 24 * 3600
+_failed_ttl_sec = 3600
+_quota_bytes = 10 * 1024 ** 3
+_min_free_bytes = 1024 ** 3
+_usage = {"work_bytes": 0, "jobs": 0, "previews": 0, "cache_bytes": 0, "free_bytes": None, "evicted": 0,
+          "owners": [], "swept_at": None}
+
+
+def _dir_size(path):
+    """資料夾內所有檔案的總大小 (bytes)"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _remove_dir(path):
+    shutil.rmtree(path, ignore_errors=True)
+    return not os.path.exists(path)
+
+
+def _free_bytes():
+    try:
+        return shutil.disk_usage(denoise_jobs.JOBS_DIR).free
+    except OSError:
+        return None
+
+
+def _last_access(job):
+    """工作的最後存取時間：被查看或下載的時間與結束時間取較晚者 (舊紀錄沒有 last_access 時以建立時間代替)"""
+    return max(job.get("last_access") or 0, job.get("finished_at") or 0, job.get("created_at") or 0)
+
+
+def _preview_dirs():
+    """回傳試聽暫存資料夾 [(路徑, 最後修改時間)] (試聽資料夾只存在於使用者的頁面工作階段中)"""
+    root = tempfile.gettempdir()
+    entries = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name.startswith(PREVIEW_PREFIX) and os.path.isdir(path):
+            try:
+                entries.append((path, os.path.getmtime(path)))
+            except OSError:
+                pass
+    return entries
+
+
+def _export_files():
+    """回傳使用數據匯出暫存檔 [(路徑, 最後修改時間)]"""
+    root = tempfile.gettempdir()
+    entries = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name.startswith(EXPORT_PREFIX) and os.path.isfile(path):
+            try:
+                entries.append((path, os.path.getmtime(path)))
+            except OSError:
+                pass
+    return entries
+
+
+def configure(ttl_hours=24, failed_ttl_hours=1, quota_mb=10240, min_free_mb=1024):
+    """設定保存期限 (小時)、暫存總容量上限 (MB，含工作資料夾、試聽暫存與快取) 與磁碟至少保留的剩餘空間 (MB)"""
+    global _ttl_sec, _failed_ttl_sec, _quota_bytes, _min_free_bytes
+    with _lock:
+        _ttl_sec = ttl_hours * 3600
+        _failed_ttl_sec = failed_ttl_hours * 3600
+        _quota_bytes = int(quota_mb * 1024 * 1024)
+        _min_free_bytes = int(min_free_mb * 1024 * 1024)
+
+
+def sweep(required_bytes=0):
+    """清理一次：刪除逾期項目，再依最後存取時間淘汰到容量與剩餘空間足夠容納 required_bytes 為止
+
+    回傳 True 表示清理後空間足夠。
+    """
+    with _lock:
+        now = time.time()
+        evicted = 0
+        active_bytes = 0
+        candidates = []  # (最後存取時間, 大小, 刪除函式)
+        sizes = {}
+        jobs = denoise_jobs.list_jobs()
+        for job in jobs:
+            size = sizes[job["id"]] = _dir_size(job["work_dir"])
+            idle = now - _last_access(job)
+            # 上傳中的工作視同執行中 (上傳過久仍未完成的才視為中斷、依失敗工作的期限刪除)
+            uploading = job["status"] == denoise_jobs.STATUS_UPLOADING
+            if job["status"] in denoise_jobs.ACTIVE_STATUSES or (uploading and idle <= _failed_ttl_sec):
+                active_bytes += size
+            else:
+                ttl = _failed_ttl_sec if job["status"] in (denoise_jobs.STATUS_FAILED, denoise_jobs.STATUS_UPLOADING) \
+                    else _ttl_sec
+                if idle > ttl and denoise_jobs.evict_job(job["id"]):
+                    evicted += 1
+                    continue
+                candidates.append((_last_access(job), size, lambda job_id=job["id"]: denoise_jobs.evict_job(job_id)))
+
+        # 沒有狀態紀錄的工作資料夾 (建立到一半時伺服器中斷) 逾期後直接刪除
+        known = {job["id"] for job in jobs}
+        if os.path.isdir(denoise_jobs.JOBS_DIR):
+            for name in os.listdir(denoise_jobs.JOBS_DIR):
+                path = os.path.join(denoise_jobs.JOBS_DIR, name)
+                try:
+                    orphaned = name not in known and now - os.path.getmtime(path) > _ttl_sec
+                except OSError:
+                    continue
+                if orphaned and not denoise_jobs.get_job(name) and _remove_dir(path):
+                    evicted += 1
+
+        for path, mtime in _preview_dirs():
+            if now - mtime > _ttl_sec and _remove_dir(path):
+                evicted += 1
+                continue
+            candidates.append((mtime, _dir_size(path), lambda path=path: _remove_dir(path)))
+
+        for path, mtime in _export_files():
+            if now - mtime > denoise_files.SHARE_TTL_SEC:
+                try:
+                    os.remove(path)
+                    evicted += 1
+                except OSError:
+                    pass
+
+        for mtime, size, path in denoise_cache.list_entries():
+            if now - mtime > _ttl_sec and denoise_cache.remove_entry(path):
+                evicted += 1
+                continue
+            candidates.append((mtime, size, lambda path=path: denoise_cache.remove_entry(path)))
+
+        # 容量淘汰：最久未使用的先刪，直到總容量與磁碟剩餘空間都足夠
+        total = active_bytes + sum(size for _, size, _ in candidates)
+        free = _free_bytes()
+
+        def short_of_space():
+            return total + required_bytes > _quota_bytes or \
+                (free is not None and free - required_bytes < _min_free_bytes)
+
+        for last_access, size, remove in sorted(candidates, key=lambda entry: entry[0]):
+            if not short_of_space():
+                break
+            if now - last_access > MIN_IDLE_SEC and remove():
+                evicted += 1
+                total -= size
+                if free is not None:
+                    free += size
+
+        # 依擁有者統計目前仍保留的工作資料夾容量
+        owners = {}
+        remaining = denoise_jobs.list_jobs()
+        for job in remaining:
+            owners[job["owner"]] = owners.get(job["owner"], 0) + sizes.get(job["id"], 0)
+        _usage.update(work_bytes=total, jobs=len(remaining), previews=len(_preview_dirs()),
+                      cache_bytes=_dir_size(denoise_cache.CACHE_DIR), free_bytes=free,
+                      evicted=_usage["evicted"] + evicted,
+                      owners=sorted(owners.items(), key=lambda item: -item[1])[:5], swept_at=now)
+        return not short_of_space()
+
+
+def ensure_space(required_bytes):
+    """送出新工作前確認暫存空間足夠 (不足時先清理)，清理後仍不足時拋出 RuntimeError"""
+    if not sweep(required_bytes):
+        raise RuntimeError("伺服器暫存空間不足，暫時無法接受新檔案，請稍後再試")
+
+
+def usage():
+    """回傳最近一次清理時統計的使用狀況
+    {"work_bytes", "jobs", "previews", "cache_bytes", "free_bytes", "evicted", "owners", "swept_at"}"""
+    with _lock:
+        return dict(_usage)
+
+
+def _janitor_loop(interval_sec):
+    while True:
+        try:
+            sweep()
+        except Exception:
+            pass
+        time.sleep(interval_sec)
+
+
+def start(interval_sec=60):
+    """啟動背景清理執行緒 (整個伺服器行程只會啟動一次)"""
+    global _thread
+    with _lock:
+        if _thread:
+            return
+        _thread = threading.Thread(target=_janitor_loop, args=(interval_sec,), name="denoise-janitor", daemon=True)
+        _thread.start()
@@ -0,0 +1,304 @@
+import os
+import json
+import time
+import uuid
+import queue
+import shutil
+import tempfile
+import itertools
+import threading
+
+# ================= 📋 背景工作佇列 =================
+# 每個工作都有自己的資料夾 (存放上傳檔、輸出檔與 job.json 狀態紀錄)，頁面重新整理或斷線後仍可依工作編號取回
+JOBS_DIR = os.path.join(tempfile.gettempdir(), "denoise_jobs")
+JOB_FILE = "job.json"
+# 降噪進度檢查點：每段完成都會更新，失敗或中斷的工作重試時從最後完成的段落繼續
+CHECKPOINT_FILE = "checkpoint.json"
+# 最後存取時間至多每隔此秒數寫回一次 (頁面每秒重新整理，避免每次都重寫 job.json)
+TOUCH_INTERVAL_SEC = 60
+
+# 上傳檔寫入與 ffprobe 檢查完成前的狀態 (尚未排入佇列，不算執行中)
+STATUS_UPLOADING = "uploading"
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+
+_lock = threading.RLock()
+_queue = queue.PriorityQueue()
+_seq = itertools.count()
+_jobs = {}
+_workers = []
+_handler = None
+_on_change = None
+_max_queued = 20
+
+
+def _save_job(job):
+    """將工作狀態原子寫入 job.json (先寫暫存檔再取代，避免讀到寫一半的內容)"""
+    path = os.path.join(job["work_dir"], JOB_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _load_job(job_id):
+    """從磁碟讀回工作狀態 (伺服器重啟後記憶體中已無紀錄時使用)"""
+    path = os.path.join(JOBS_DIR, job_id, JOB_FILE)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def _enqueue(job):
+    _queue.put((job["priority"], job["seq"], job["id"]))
+
+
+def _restore_jobs():
+    """伺服器重啟時讀回既有工作：排隊中的重新排入佇列，執行到一半的標記為中斷，上傳到一半的標記為失敗"""
+    if not os.path.isdir(JOBS_DIR):
+        return
+    for job_id in os.listdir(JOBS_DIR):
+        job = _load_job(job_id)
+        if not job:
+            continue
+        job["seq"] = next(_seq)
+        _jobs[job_id] = job
+        if job["status"] == STATUS_QUEUED:
+            _enqueue(job)
+        elif job["status"] == STATUS_RUNNING:
+            job.update(status=STATUS_FAILED, finished_at=time.time(),
+                       message="伺服器重新啟動，工作已中斷，請按「重試」從中斷處繼續")
+            _save_job(job)
+            prune_failed_job(job_id)
+        elif job["status"] == STATUS_UPLOADING:
+            # 上傳檔可能不完整，不能重試
+            job.update(status=STATUS_FAILED, finished_at=time.time(), media=None,
+                       message="伺服器重新啟動，上傳未完成，請重新上傳檔案")
+            _save_job(job)
+            prune_failed_job(job_id)
+
+
+def _worker_loop():
+    while True:
+        _, _, job_id = _queue.get()
+        with _lock:
+            job = _jobs.get(job_id)
+            if not job or job["status"] != STATUS_QUEUED:
+                continue
+            job.update(status=STATUS_RUNNING, started_at=time.time())
+            _save_job(job)
+        _notify()
+
+        def report(progress, message):
+            update_job(job_id, progress=progress, message=message)
+
+        try:
+            success, msg = _handler(dict(job), report)
+        except Exception as e:
+            success, msg = False, f"發生錯誤: {str(e)}"
+        update_job(job_id, status=STATUS_DONE if success else STATUS_FAILED, message=msg,
+                   progress=1.0 if success else job["progress"], finished_at=time.time())
+        if not success:
+            prune_failed_job(job_id)
+        _notify()
+
+
+def _notify():
+    """工作開始或結束時通知呼叫端 (例如更新監控指標)，通知失敗不影響工作本身"""
+    if _on_change:
+        try:
+            _on_change()
+        except Exception:
+            pass
+
+
+def start_workers(handler, workers=1, max_queued=20, on_change=None):
+    """啟動背景工作執行緒 (整個伺服器行程只會啟動一次)
+
+    handler(job, report) 負責實際處理並回傳 (是否成功, 訊息)；report(progress, message) 用來回報進度；
+    on_change() 會在每個工作開始與結束時被呼叫。
+    """
+    global _handler, _on_change, _max_queued
+    with _lock:
+        _handler = handler
+        _on_change = on_change
+        _max_queued = max_queued
+        if _workers:
+            return
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        _restore_jobs()
+        for i in range(max(1, workers)):
+            worker = threading.Thread(target=_worker_loop, name=f"denoise-worker-{i}", daemon=True)
+            worker.start()
+            _workers.append(worker)
+
+
+def create_job(owner, original_name, atten_lim_db, file_size_mb, output_name, priority=0, channel_mode=""):
+    """建立工作資料夾與狀態紀錄 (上傳中，尚未排入佇列)；排隊人數 (含上傳中) 已滿時拋出 RuntimeError"""
+    with _lock:
+        queued = sum(1 for job in _jobs.values() if job["status"] in (STATUS_UPLOADING, STATUS_QUEUED))
+        if queued >= _max_queued:
+            raise RuntimeError(f"目前排隊工作已達上限 ({_max_queued} 件)，請稍後再試")
+
+        job_id = uuid.uuid4().hex[:12]
+        work_dir = os.path.join(JOBS_DIR, job_id)
+        os.makedirs(work_dir, exist_ok=True)
+        job = {
+            "id": job_id,
+            "owner": owner,
+            "original_name": original_name,
+            "atten_lim_db": atten_lim_db,
+            "file_size_mb": file_size_mb,
+            "channel_mode": channel_mode,
+            "priority": priority,
+            "seq": next(_seq),
+            "status": STATUS_UPLOADING,
+            "progress": 0.0,
+            "message": "上傳中...",
+            "work_dir": work_dir,
+            "input_path": os.path.join(work_dir, original_name),
+            "output_path": os.path.join(work_dir, output_name),
+            "output_name": output_name,
+            "preview_path": None,
+            "media": None,
+            "input_hash": None,
+            "cache_key": None,
+            "cache_hit": False,
+            "spans": [],
+            "skipped_ratio": None,
+            "threads": None,
+            "wait_sec": None,
+            "created_at": time.time(),
+            "last_access": time.time(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        _jobs[job_id] = job
+        _save_job(job)
+        return dict(job)
+
+
+def enqueue_job(job_id):
+    """上傳檔寫入工作資料夾並通過檢查後，正式排入佇列 (數字越小越優先，同優先度先到先處理)"""
+    with _lock:
+        job = _jobs[job_id]
+        job.update(status=STATUS_QUEUED, message="排隊中...")
+        _save_job(job)
+        _enqueue(job)
+
+
+def retry_job(job_id):
+    """將失敗的工作重新排入佇列 (沿用工作資料夾內的上傳檔與檢查點)，回傳是否成功排入"""
+    with _lock:
+        job = _jobs.get(job_id)
+        # 未通過 ffprobe 檢查 (沒有媒體資訊) 的檔案重試也不會成功
+        if not job or job["status"] != STATUS_FAILED or not job.get("media") or not os.path.exists(job["input_path"]):
+            return False
+        queued = sum(1 for other in _jobs.values() if other["status"] == STATUS_QUEUED)
+        if queued >= _max_queued:
+            return False
+        job.update(status=STATUS_QUEUED, progress=0.0, message="排隊中 (將從中斷處繼續)...", seq=next(_seq),
+                   started_at=None, finished_at=None)
+        _save_job(job)
+        _enqueue(job)
+        return True
+
+
+def prune_failed_job(job_id):
+    """失敗的工作立即刪除不完整的輸出檔；可續跑的工作保留上傳檔、降噪暫存與檢查點 (逾期後由暫存清理整個刪除)，
+    未通過 ffprobe 檢查的工作無法重試，上傳檔一併刪除 (只留下狀態紀錄以顯示錯誤訊息)"""
+    with _lock:
+        job = _jobs.get(job_id)
+        if not job or job["status"] != STATUS_FAILED:
+            return
+        leftovers = [job["output_path"], job.get("preview_path")]
+        if not job.get("media"):
+            leftovers.append(job["input_path"])
+        for path in leftovers:
+            if path and os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def update_job(job_id, **fields):
+    with _lock:
+        job = _jobs.get(job_id)
+        if job:
+            job.update(fields)
+            _save_job(job)
+
+
+def get_job(job_id):
+    """依工作編號取得狀態副本，記憶體中沒有時從磁碟讀回"""
+    with _lock:
+        job = _jobs.get(job_id)
+        if job:
+            return dict(job)
+    return _load_job(job_id) if job_id else None
+
+
+def touch_job(job_id):
+    """記錄工作最近一次被查看或下載的時間，作為暫存清理的閒置依據"""
+    with _lock:
+        job = _jobs.get(job_id)
+        now = time.time()
+        if job and now - (job.get("last_access") or 0) >= TOUCH_INTERVAL_SEC:
+            job["last_access"] = now
+            _save_job(job)
+
+
+def list_jobs():
+    """回傳所有工作的狀態副本 (暫存清理依擁有者、狀態與最後存取時間判斷)"""
+    with _lock:
+        return [dict(job) for job in _jobs.values()]
+
+
+def queue_position(job_id):
+    """回傳排在此工作前面的排隊件數 (不含執行中的工作)"""
+    with _lock:
+        job = _jobs.get(job_id)
+        if not job or job["status"] != STATUS_QUEUED:
+            return 0
+        key = (job["priority"], job["seq"])
+        return sum(1 for other in _jobs.values()
+                   if other["status"] == STATUS_QUEUED and (other["priority"], other["seq"]) < key)
+
+
+def queue_stats():
+    """回傳 (執行中件數, 排隊中件數)"""
+    with _lock:
+        running = sum(1 for job in _jobs.values() if job["status"] == STATUS_RUNNING)
+        queued = sum(1 for job in _jobs.values() if job["status"] == STATUS_QUEUED)
+        return running, queued
+
+
+def remove_job(job_id):
+    """刪除工作與其暫存檔；排隊中的工作會被取消，執行中的工作則保留至結束"""
+    with _lock:
+        job = _jobs.get(job_id) or _load_job(job_id)
+        if not job:
+            return
+        if job["status"] == STATUS_RUNNING:
+            return
+        job["status"] = STATUS_CANCELLED
+        _jobs.pop(job_id, None)
+        shutil.rmtree(job["work_dir"], ignore_errors=True)
+
+
+def evict_job(job_id):
+    """暫存清理使用：只刪除已結束 (完成、失敗、取消) 的工作，回傳是否已刪除"""
+    with _lock:
+        job = _jobs.get(job_id)
+        if not job or job["status"] in ACTIVE_STATUSES:
+            return False
+        _jobs.pop(job_id)
+        shutil.rmtree(job["work_dir"], ignore_errors=True)
+        return True
@@ -0,0 +1,156 @@
+import os
+import time
+import threading
+import contextlib
+
+# ================= ⏱️ 階段計時與監控指標 =================
+# 每個工作以一份 spans 清單記錄各階段耗時：[{"stage": 階段名稱, "seconds": 秒數}, ...]
+# 階段可以巢狀 (例如降噪串流向解碼串流要資料)，外層只計入扣除內層後的自身耗時，各階段加總不會重複計算。
+# 同時累計成 Prometheus 直方圖，由 write_metrics_file 輸出為文字格式 (可交給 node_exporter textfile collector 收集)。
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+_lock = threading.Lock()
+_histograms = {}
+_model_loads = 0
+_local = threading.local()
+_active = {}  # 執行緒編號 → 進行中的階段名稱 (由外而內)，供效能測試取樣時判斷各執行緒目前所在的階段
+_END = object()
+
+
+def _observe(stage, seconds):
+    with _lock:
+        hist = _histograms.get(stage)
+        if hist is None:
+            hist = _histograms[stage] = {"buckets": [0] * len(STAGE_BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(STAGE_BUCKETS):
+            if seconds <= bound:
+                hist["buckets"][i] += 1
+        hist["sum"] += seconds
+        hist["count"] += 1
+
+
+def record(spans, stage, seconds):
+    """記錄一段已知耗時的階段 (spans 為 None 時只累計直方圖)"""
+    _observe(stage, seconds)
+    if spans is not None:
+        spans.append({"stage": stage, "seconds": round(seconds, 4)})
+
+
+@contextlib.contextmanager
+def _measure(stage=None):
+    """量測區塊的自身耗時 (扣除同一執行緒內巢狀區塊)，結束後寫入 yield 出的 result[0]"""
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(0.0)
+    thread_id = threading.get_ident()
+    names = _active.setdefault(thread_id, [])
+    names.append(stage)
+    result = [0.0]
+    start = time.perf_counter()
+    try:
+        yield result
+    finally:
+        elapsed = time.perf_counter() - start
+        names.pop()
+        if not names:
+            _active.pop(thread_id, None)
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        result[0] = elapsed - nested
+
+
+@contextlib.contextmanager
+def span(spans, stage):
+    """計時一個階段；同一執行緒內巢狀的階段耗時會從外層扣除"""
+    with _measure(stage) as result:
+        yield
+    record(spans, stage, result[0])
+
+
+def timed_iter(iterable, spans, stage, per_item=True):
+    """包裝串流並計時每次取出下一個元素的耗時
+
+    per_item=True 時每個元素記錄一段 (例如每段降噪結果)，否則串流結束後合計記錄為一段。
+    """
+    iterator = iter(iterable)
+    total = 0.0
+    try:
+        while True:
+            with _measure(stage) as result:
+                item = next(iterator, _END)
+            if item is _END:
+                total += result[0]
+                break
+            if per_item:
+                record(spans, stage, result[0])
+            else:
+                total += result[0]
+            yield item
+    finally:
+        if not per_item:
+            record(spans, stage, total)
+
+
+def current_stage(thread_id):
+    """回傳指定執行緒目前所在 (最內層) 的階段名稱，不在任何階段中時回傳 None"""
+    try:
+        return _active.get(thread_id, [None])[-1]
+    except IndexError:
+        # 取樣時該執行緒剛好離開最外層階段
+        return None
+
+
+def summarize(spans):
+    """將 spans 依階段彙總為 {階段: {"count": 段數, "seconds": 總耗時}}"""
+    summary = {}
+    for item in spans:
+        entry = summary.setdefault(item["stage"], {"count": 0, "seconds": 0.0})
+        entry["count"] += 1
+        entry["seconds"] = round(entry["seconds"] + item["seconds"], 4)
+    return summary
+
+
+def count_model_load():
+    """模型實際初始化一次 (非快取命中) 時呼叫"""
+    global _model_loads
+    with _lock:
+        _model_loads += 1
+
+
+def model_loads():
+    with _lock:
+        return _model_loads
+
+
+def render_prometheus(gauges=None):
+    """輸出 Prometheus 文字格式：各階段耗時直方圖、模型載入次數與呼叫端提供的即時量測值 (例如佇列長度)"""
+    lines = [
+        "# HELP denoise_stage_seconds 各處理階段耗時 (秒)",
+        "# TYPE denoise_stage_seconds histogram",
+    ]
+    with _lock:
+        for stage in sorted(_histograms):
+            hist = _histograms[stage]
+            for bound, count in zip(STAGE_BUCKETS, hist["buckets"]):
+                lines.append(f'denoise_stage_seconds_bucket{{stage="{stage}",le="{bound:g}"}} {count}')
+            lines.append(f'denoise_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist["count"]}')
+            lines.append(f'denoise_stage_seconds_sum{{stage="{stage}"}} {hist["sum"]:.6f}')
+            lines.append(f'denoise_stage_seconds_count{{stage="{stage}"}} {hist["count"]}')
+        lines += [
+            "# HELP denoise_model_loads_total 模型初始化次數 (不含快取命中)",
+            "# TYPE denoise_model_loads_total counter",
+            f"denoise_model_loads_total {_model_loads}",
+        ]
+    for name, value in sorted((gauges or {}).items()):
+        lines += [f"# TYPE denoise_{name} gauge", f"denoise_{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics_file(path, gauges=None):
+    """原子寫入指標檔 (先寫暫存檔再取代，收集端不會讀到寫一半的內容)"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render_prometheus(gauges))
+    os.replace(tmp_path, path)
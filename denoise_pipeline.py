@@ -0,0 +1,298 @@
+import os
+import json
+import time
+import itertools
+import subprocess
+import torch
+from denoise_engine import (
+    enhance_stream, enhance_parallel, enhance_strengths,
+    DEFAULT_CHUNK_SEC, DEFAULT_CONTEXT_SEC, DEFAULT_OVERLAP_SEC, DEFAULT_SHARD_SEC
+)
+from denoise_io import (
+    PCM_BYTES, probe_duration, probe_media, channel_layout, is_direct_wav, read_wav_blocks,
+    decode_audio_blocks, encode_audio, pcm_bytes, read_pcm_blocks, tee_pcm_blocks, skip_samples
+)
+from denoise_metrics import record, span, timed_iter
+
+# ================= 🎬 降噪處理流程 (提取 → 降噪 → 正規化 → 合成) =================
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".m4a", ".aac", ".flac")
+
+# 🌟 v1.1 智能音量正規化：目標音量上限 -1.0 dBFS (約等於 0.891 的振幅，預留安全空間防破音)
+TARGET_PEAK_DB = -1.0
+
+
+def output_name_for(original_name, atten_lim_db):
+    """依原始檔名與降噪強度決定輸出檔名，並回傳是否為純音檔"""
+    name, ext = os.path.splitext(original_name)
+    is_audio_only = ext.lower() in AUDIO_EXTENSIONS
+    output_ext = ext if is_audio_only else ".mp4"
+    return f"{name}_{atten_lim_db}db{output_ext}", is_audio_only
+
+
+def peak_gain(peak_amplitude):
+    """計算將峰值放大至 TARGET_PEAK_DB 所需的增益 (完全靜音時不調整)"""
+    target_amplitude = 10 ** (TARGET_PEAK_DB / 20)
+    return target_amplitude / peak_amplitude if peak_amplitude > 0 else 1.0
+
+
+def inspect_input(input_path):
+    """在任何模型運算之前以 ffprobe 檢查輸入檔，回傳媒體資訊；損毀、格式不支援或沒有音軌時拋出 RuntimeError"""
+    try:
+        media = probe_media(input_path)
+    except subprocess.CalledProcessError as e:
+        detail = e.stderr.decode("utf-8", errors="ignore").strip() if e.stderr else "無詳細錯誤"
+        raise RuntimeError(f"無法讀取此檔案，可能已損毀或格式不支援: {detail}")
+    if not media["audio"]:
+        raise RuntimeError("此檔案中沒有任何音軌，無法進行降噪")
+    return media
+
+
+def _load_checkpoint(checkpoint_path, identity, spool_path, channels):
+    """讀回與本次參數相符的檢查點，並將降噪暫存檔截到最後完成的段落；不存在或參數不同時回傳 None"""
+    try:
+        with open(checkpoint_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    done_bytes = manifest.get("done_samples", 0) * channels * PCM_BYTES
+    if manifest.get("identity") != identity or not manifest.get("completed_chunks") \
+            or not os.path.exists(spool_path) or os.path.getsize(spool_path) < done_bytes:
+        return None
+    # 中斷時可能寫到一半的段落直接捨棄
+    with open(spool_path, "r+b") as f:
+        f.truncate(done_bytes)
+    return manifest
+
+
+def _trim_pcm(pcm_path, channels):
+    """將中斷時留下的解碼暫存檔截到完整的樣本為止，回傳其中的樣本數 (不存在時為 0)"""
+    if not os.path.exists(pcm_path):
+        return 0
+    samples = os.path.getsize(pcm_path) // (PCM_BYTES * channels)
+    with open(pcm_path, "r+b") as f:
+        f.truncate(samples * PCM_BYTES * channels)
+    return samples
+
+
+def _take_samples(blocks, count):
+    """從音訊塊串流取出前 count 個樣本合併為一段，回傳 (該段, 其餘的串流)"""
+    blocks = iter(blocks)
+    head = []
+    taken = 0
+    for block in blocks:
+        need = count - taken
+        if block.shape[-1] > need:
+            head.append(block[:, :need])
+            blocks = itertools.chain([block[:, need:]], blocks)
+            break
+        head.append(block)
+        taken += block.shape[-1]
+        if taken == count:
+            break
+    return (torch.cat(head, dim=-1) if head else None), blocks
+
+
+def _save_checkpoint(checkpoint_path, manifest):
+    """原子寫入檢查點 (先寫暫存檔再取代，中斷時不會留下寫一半的內容)"""
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def run_preview(input_path, preview_dir, start_sec, duration_sec, atten_levels, model, df_state):
+    """快速試聽：只解碼指定片段，一次前向運算產生多種強度的 MP3 試聽檔
+
+    回傳 {強度: 檔案路徑}，其中強度 0 為原始音訊。每段都正規化至與正式輸出相同的峰值，方便公平比較。
+    """
+    sr = df_state.sr()
+    blocks = decode_audio_blocks(input_path, sr, block_samples=int(duration_sec * sr),
+                                 seek_sec=start_sec, duration_sec=duration_sec)
+    excerpt = torch.cat(list(blocks), dim=-1)
+    clips = enhance_strengths(model, df_state, excerpt, atten_levels)
+    clips[0] = excerpt
+
+    os.makedirs(preview_dir, exist_ok=True)
+    paths = {}
+    for atten_lim_db, clip in clips.items():
+        path = os.path.join(preview_dir, f"preview_{atten_lim_db}db.mp3")
+        clip = clip * peak_gain(float(torch.max(torch.abs(clip))))
+        encode_audio([clip], path, sr)
+        paths[atten_lim_db] = path
+    return paths
+
+
+def run_pipeline(input_path, output_path, atten_lim_db, model, df_state, is_audio_only,
+                 progress_cb=None, chunk_sec=DEFAULT_CHUNK_SEC, context_sec=DEFAULT_CONTEXT_SEC,
+                 overlap_sec=DEFAULT_OVERLAP_SEC, batch_size=1, pool=None,
+                 shard_sec=DEFAULT_SHARD_SEC, max_pending=4, pcm_cache_path=None, spans=None,
+                 skip_silence=False, media=None, layout=None, ffmpeg_threads=0,
+                 checkpoint_path=None, checkpoint_key=None, resume_cb=None):
+    """完整處理一個影音檔案，不依賴 Streamlit，失敗時直接拋出例外
+
+    progress_cb(done_samples, total_samples) 會在每段降噪完成後被呼叫；
+    pool 不為 None 時改以行程池平行處理；pcm_cache_path 指向解碼快取，存在時直接讀取、不存在時邊解碼邊寫入；
+    spans 為清單時會依序附加各階段耗時 (probe、extract、每段 enhance、save、normalize、mux)；
+    skip_silence 為 True 時沒有人聲的段落不送進模型；media 為 inspect_input 的結果，
+    已是模型取樣率、聲道數相同的 PCM WAV 時直接讀取、不經過 ffmpeg 解碼；
+    layout 為 channel_layout 的結果 (每條輸出音軌的聲道數，預設 [1] 即混成單聲道)，
+    所有聲道 (含多條音軌) 疊成同一個 batch 一次送進模型，輸出時再依原本的音軌與聲道配置封裝；
+    ffmpeg_threads 為解碼與編碼可使用的執行緒數 (0 = 由 ffmpeg 自動決定)。
+    checkpoint_path 不為 None (且有 pcm_cache_path 或可直接讀取的 WAV) 時，每段降噪結果寫入磁碟後都會更新檢查點
+    (checkpoint_key 與處理參數、已完成段數、峰值)；以相同參數重跑時從最後完成的段落接續，不必重新降噪，
+    輸入從解碼快取、上次已解碼的部分或 WAV 中途讀起，並在開始前呼叫一次 resume_cb(已完成樣本數, 總樣本數)。
+    回傳處理統計 {"total_samples", "skipped_samples", "resumed_samples"}。
+    """
+    sr = df_state.sr()
+    block_samples = int(chunk_sec * sr)
+    layout = layout or [1]
+    channels = sum(layout)
+    spool_path = output_path + ".f32"
+    input_pcm_path = output_path + ".in.f32"
+
+    # 0. 檢查點：段落大小即引擎每次輸出的長度 (平行模式為分片長度)
+    chunk_samples = max(int((shard_sec if pool is not None else chunk_sec) * sr), 1)
+    direct = len(layout) == 1 and is_direct_wav(media, sr, channels)
+    identity = manifest = None
+    if checkpoint_path and (pcm_cache_path or direct):
+        identity = dict(checkpoint_key or {}, sr=sr, layout=list(layout), chunk_samples=chunk_samples,
+                        context_sec=context_sec, overlap_sec=overlap_sec, skip_silence=bool(skip_silence))
+        manifest = _load_checkpoint(checkpoint_path, identity, spool_path, channels)
+    completed = manifest["completed_chunks"] if manifest else 0
+    # 續跑時從最後完成的段落開頭讀起：該段只用來重建交叉淡化的重疊區，前方再補上暖機上下文
+    start = max(completed - 1, 0) * chunk_samples
+    begin = start - min(int(context_sec * sr), start)
+
+    # 1. 串流解碼音訊 (ffmpeg 直接輸出 PCM 至管線，不寫出暫存 WAV；已有解碼快取時略過 ffmpeg)，從 begin 開始
+    if pcm_cache_path and os.path.exists(pcm_cache_path):
+        total_samples = os.path.getsize(pcm_cache_path) // (PCM_BYTES * channels)
+        noisy_blocks = timed_iter(read_pcm_blocks(pcm_cache_path, block_samples=block_samples, channels=channels,
+                                                  start=begin),
+                                  spans, "extract_cached", per_item=False)
+    elif direct:
+        total_samples = int(media["duration"] * sr) if media["duration"] else 0
+        noisy_blocks = timed_iter(read_wav_blocks(input_path, block_samples, start=begin),
+                                  spans, "extract_direct", per_item=False)
+    else:
+        if media:
+            media_duration = media["duration"]
+        else:
+            with span(spans, "probe"):
+                media_duration = probe_duration(input_path)
+        total_samples = int(media_duration * sr) if media_duration else 0
+        noisy_blocks = decode_audio_blocks(input_path, sr, block_samples=block_samples,
+                                           channels=channels, streams=len(layout), threads=ffmpeg_threads)
+        if pcm_cache_path and identity is not None:
+            # 有檢查點時解碼結果同時接續寫入工作專屬的暫存檔：檢查點記錄的段落都已寫入該檔，
+            # 續跑時已解碼的部分直接讀回，只需解碼 (並捨棄) 到暫存檔結尾，再接著寫入其餘部分
+            teed = _trim_pcm(input_pcm_path, channels) if start else 0
+            if not start and os.path.exists(input_pcm_path):
+                os.remove(input_pcm_path)
+            noisy_blocks = itertools.chain(
+                read_pcm_blocks(input_pcm_path, block_samples=block_samples, channels=channels,
+                                start=min(begin, teed), stop=teed) if teed else (),
+                tee_pcm_blocks(skip_samples(noisy_blocks, teed), pcm_cache_path, partial_path=input_pcm_path))
+            noisy_blocks = skip_samples(noisy_blocks, max(begin - teed, 0))
+        elif pcm_cache_path:
+            noisy_blocks = tee_pcm_blocks(noisy_blocks, pcm_cache_path)
+        noisy_blocks = timed_iter(noisy_blocks, spans, "extract", per_item=False)
+    history = None
+    if start > begin:
+        history, noisy_blocks = _take_samples(noisy_blocks, start - begin)
+
+    # 2. AI 降噪運算：重疊視窗 + 交叉淡化，多段視窗批次送入模型；有行程池時改為分片平行處理
+    stats = {}
+    resume = {"history": history, "prime": completed > 0}
+    if manifest and manifest["done_samples"] >= total_samples:
+        # 中斷前已完成所有段落 (例如在合成階段中斷)，直接進行合成
+        clean_stream = iter(())
+    elif pool is not None:
+        clean_stream = enhance_parallel(pool, df_state, noisy_blocks, atten_lim_db,
+                                        shard_sec=shard_sec, chunk_sec=chunk_sec, context_sec=context_sec,
+                                        overlap_sec=overlap_sec, batch_size=batch_size,
+                                        max_pending=max_pending, skip_silence=skip_silence, stats=stats, **resume)
+    else:
+        clean_stream = enhance_stream(model, df_state, noisy_blocks, atten_lim_db,
+                                      chunk_sec=chunk_sec, context_sec=context_sec, overlap_sec=overlap_sec,
+                                      batch_size=batch_size, skip_silence=skip_silence, stats=stats, **resume)
+    clean_stream = timed_iter(clean_stream, spans, "enhance")
+
+    # 降噪結果邊算邊寫入磁碟暫存檔並同步追蹤峰值，記憶體只需容納一段
+    peak_amplitude = manifest["peak_amplitude"] if manifest else 0.0
+    done_samples = resumed_samples = manifest["done_samples"] if manifest else 0
+    skipped_before = manifest["skipped_samples"] if manifest else 0
+    if resumed_samples and resume_cb:
+        resume_cb(resumed_samples, max(total_samples, resumed_samples))
+    # 寫入、檢查點與峰值追蹤每段只需幾毫秒，累計後各記錄為一段
+    save_sec = normalize_sec = 0.0
+    with open(spool_path, "ab" if manifest else "wb") as spool:
+        for clean_chunk in clean_stream:
+            tick = time.perf_counter()
+            peak_amplitude = max(peak_amplitude, float(torch.max(torch.abs(clean_chunk))))
+            tock = time.perf_counter()
+            spool.write(pcm_bytes(clean_chunk))
+            done_samples += clean_chunk.shape[-1]
+            if identity is not None:
+                # 先確定本段已寫入磁碟，再記錄為已完成
+                spool.flush()
+                os.fsync(spool.fileno())
+                completed += 1
+                _save_checkpoint(checkpoint_path, {
+                    "identity": identity, "completed_chunks": completed, "done_samples": done_samples,
+                    "peak_amplitude": peak_amplitude,
+                    "skipped_samples": skipped_before + stats.get("skipped_samples", 0),
+                })
+            normalize_sec += tock - tick
+            save_sec += time.perf_counter() - tock
+            # 長度以 ffprobe 預估，解碼後的實際長度可能略有出入
+            total_samples = max(total_samples, done_samples)
+            if progress_cb:
+                progress_cb(done_samples, total_samples)
+
+    # 3. 音量正規化：如果聲音不是完全靜音，就將整體音量等比例放大至安全極限 (讀回暫存檔時才套用)
+    gain = peak_gain(peak_amplitude)
+    record(spans, "save", save_sec)
+    record(spans, "normalize", normalize_sec)
+
+    # 4. 合成最終影音檔案 (音訊直接經由管線送進 ffmpeg 編碼 / 封裝)
+    clean_blocks = read_pcm_blocks(spool_path, block_samples=block_samples, channels=channels, gain=gain)
+    with span(spans, "mux"):
+        encode_audio(clean_blocks, output_path, sr, video_path=None if is_audio_only else input_path,
+                     channels=channels, layout=layout, threads=ffmpeg_threads)
+    os.remove(spool_path)
+    if identity is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    if os.path.exists(input_pcm_path):
+        # 續跑時改讀其他工作已完成的快取，或中斷前已完成所有段落時，解碼暫存檔不會被移入快取
+        os.remove(input_pcm_path)
+    stats["total_samples"] = stats.get("total_samples", 0) + resumed_samples
+    stats["skipped_samples"] = stats.get("skipped_samples", 0) + skipped_before
+    stats["resumed_samples"] = resumed_samples
+    return stats
+
+
+def process_file(input_path, output_path, atten_lim_db, model, df_state, **options):
+    """處理單一檔案的對外介面 (命令列批次處理使用)
+
+    先以 ffprobe 檢查輸入 (損毀或沒有音軌時在解碼任何音訊前就拋出 RuntimeError)，
+    再寫到同資料夾的暫存檔名，成功後才改名為 output_path，中斷時不會留下不完整的輸出。
+    keep_channels / all_streams 為 True 時保留原始聲道 / 所有音軌 (見 channel_layout)。
+    其餘參數與回傳值皆與 run_pipeline 相同。
+    """
+    is_audio_only = os.path.splitext(input_path)[1].lower() in AUDIO_EXTENSIONS
+    if options.get("media") is None:
+        options["media"] = inspect_input(input_path)
+    keep_channels = options.pop("keep_channels", False)
+    all_streams = options.pop("all_streams", False)
+    if options.get("layout") is None:
+        options["layout"] = channel_layout(options["media"], is_audio_only, keep_channels, all_streams)
+    name, ext = os.path.splitext(output_path)
+    partial_path = f"{name}.partial{ext}"
+    try:
+        stats = run_pipeline(input_path, partial_path, atten_lim_db, model, df_state, is_audio_only, **options)
+        os.replace(partial_path, output_path)
+        return stats
+    finally:
+        for leftover in (partial_path, partial_path + ".f32"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
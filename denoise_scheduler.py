@@ -0,0 +1,137 @@
+import os
+import time
+import threading
+import contextlib
+import torch
+from denoise_engine import available_memory
+
+# ================= 🧮 CPU / 記憶體資源排程 =================
+# 整個伺服器行程共用一份固定的 CPU 預算 (執行緒數)，由執行中的工作平均分配：
+# 工作開始或結束時重新分配，ffmpeg (-threads) 使用各工作分得的執行緒數 (由呼叫端套用)。
+# torch 的執行緒數是整個行程共用的設定 (在任一執行緒呼叫 torch.set_num_threads 都會影響所有執行緒)，
+# 因此由排程統一設為「預算 / 執行中的工作數」，每個工作的模型推論各用一份，合計不超過預算。
+# 剩餘 CPU 或記憶體不足以再開始一個工作時，新工作依到達順序在此等待，不會與執行中的工作互搶資源。
+_cond = threading.Condition()
+_budget = os.cpu_count() or 1
+_min_threads = 1
+_allocations = {}  # 工作編號 → {"threads", "memory", "admitted_at", "wait_sec"}
+_waiting = []  # 等待中的工作編號 (先到先分配)
+
+
+def configure(budget=0, min_threads=1):
+    """設定 CPU 預算 (執行緒總數，0 = 全部核心) 與每個工作至少分得的執行緒數"""
+    global _budget, _min_threads
+    with _cond:
+        _budget = budget if budget > 0 else (os.cpu_count() or 1)
+        _min_threads = max(1, min(min_threads, _budget))
+        _rebalance()
+        _cond.notify_all()
+
+
+def _rebalance():
+    """將 CPU 預算平均分給執行中的工作，除不盡的部分給較早開始的工作，並套用整個行程共用的 torch 執行緒數"""
+    torch_threads = max(_min_threads, _budget // max(len(_allocations), 1))
+    if torch.get_num_threads() != torch_threads:
+        torch.set_num_threads(torch_threads)
+    if not _allocations:
+        return
+    share, extra = divmod(_budget, len(_allocations))
+    ordered = sorted(_allocations.items(), key=lambda item: item[1]["admitted_at"])
+    for i, (_, allocation) in enumerate(ordered):
+        allocation["threads"] = max(_min_threads, share + (1 if i < extra else 0))
+
+
+def _can_admit(job_id, memory):
+    # 依到達順序分配：前面還有工作在等時不可插隊
+    if _waiting and _waiting[0] != job_id:
+        return False
+    # 沒有執行中的工作時一律放行 (即使記憶體估計不足，也不能讓工作永遠等待)
+    if not _allocations:
+        return True
+    if (len(_allocations) + 1) * _min_threads > _budget:
+        return False
+    available = available_memory()
+    # 尚未開始大量使用記憶體的工作也要扣除其預估用量
+    reserved = sum(allocation["memory"] for allocation in _allocations.values())
+    return available is None or memory <= available - reserved
+
+
+def acquire(job_id, memory=0, on_wait=None, poll_sec=1.0, timeout=None):
+    """等待到有足夠的 CPU 與記憶體後分配資源，回傳分得的執行緒數
+
+    memory 為此工作預估的記憶體用量 (bytes)；on_wait(wait_sec, position) 會在等待期間約每 poll_sec 秒
+    被呼叫一次 (position 為前面還在等待的件數)，用來回報狀態。
+    timeout 不為 None 時最多等待 timeout 秒，逾時仍未分配到資源時放棄排隊並拋出 RuntimeError。
+    """
+    start = time.time()
+    with _cond:
+        _waiting.append(job_id)
+    try:
+        while True:
+            with _cond:
+                if _can_admit(job_id, memory):
+                    _waiting.remove(job_id)
+                    _allocations[job_id] = {"threads": _min_threads, "memory": memory,
+                                            "admitted_at": time.time(), "wait_sec": time.time() - start}
+                    _rebalance()
+                    _cond.notify_all()
+                    return _allocations[job_id]["threads"]
+                position = _waiting.index(job_id)
+            if timeout is not None and time.time() - start >= timeout:
+                raise RuntimeError("目前運算資源忙碌中，請稍後再試")
+            # 回報狀態時不持有鎖，避免回呼中的磁碟寫入拖慢其他工作
+            if on_wait:
+                on_wait(time.time() - start, position)
+            with _cond:
+                # 記憶體會隨其他工作的進度變化，因此除了被喚醒之外也定期重新檢查
+                if not _can_admit(job_id, memory):
+                    _cond.wait(poll_sec)
+    except BaseException:
+        with _cond:
+            if job_id in _waiting:
+                _waiting.remove(job_id)
+            _cond.notify_all()
+        raise
+
+
+def release(job_id):
+    """工作結束時歸還資源，並重新分配給其餘執行中的工作"""
+    with _cond:
+        if _allocations.pop(job_id, None) is not None:
+            _rebalance()
+        _cond.notify_all()
+
+
+def threads_for(job_id):
+    """回傳工作目前分得的執行緒數 (其他工作開始或結束後會變動，未分配時回傳 0)"""
+    with _cond:
+        allocation = _allocations.get(job_id)
+        return allocation["threads"] if allocation else 0
+
+
+def wait_time(job_id):
+    """回傳工作等待資源的秒數 (未分配時回傳 0)"""
+    with _cond:
+        allocation = _allocations.get(job_id)
+        return allocation["wait_sec"] if allocation else 0.0
+
+
+@contextlib.contextmanager
+def allocation(job_id, memory=0, on_wait=None, timeout=None):
+    """以 with 區塊持有資源：進入時等待分配 (產生分得的執行緒數，逾時拋出 RuntimeError)，離開時歸還"""
+    threads = acquire(job_id, memory, on_wait, timeout=timeout)
+    try:
+        yield threads
+    finally:
+        release(job_id)
+
+
+def snapshot():
+    """回傳目前的資源使用狀況 {"budget", "allocated", "running", "waiting"}"""
+    with _cond:
+        return {
+            "budget": _budget,
+            "allocated": sum(allocation["threads"] for allocation in _allocations.values()),
+            "running": len(_allocations),
+            "waiting": len(_waiting),
+        }
@@ -0,0 +1,217 @@
+import os
+import csv
+import time
+import sqlite3
+import datetime
+import threading
+
+# ================= 📊 使用紀錄資料庫 (SQLite WAL 版) =================
+DB_FILE = "denoise_usage.db"
+# 舊版 CSV 日誌：資料庫第一次建立時自動匯入，歷史紀錄不會遺失
+LEGACY_CSV_FILE = "denoise_usage_log.csv"
+
+CSV_HEADER = ["處理時間", "使用者姓名", "原始檔名", "檔案類型", "檔案大小(MB)", "降噪強度(dB)", "處理耗時(秒)", "處理狀態", "錯誤詳細資訊", "快取命中", "略過靜音比例"]
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".m4a", ".aac", ".flac")
+# 強制設定為台灣台北時間 (UTC+8)
+TZ_TAIPEI = datetime.timezone(datetime.timedelta(hours=8))
+
+STATUS_SUCCESS = "成功"
+STATUS_FAILED = "失敗"
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def _connect():
+    conn = sqlite3.connect(DB_FILE, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def init_store():
+    """建立資料表、索引與累計計數器 (每個行程只執行一次)"""
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        conn = _connect()
+        try:
+            with conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS usage (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        created_ts REAL NOT NULL,
+                        created_at TEXT NOT NULL,
+                        user_name TEXT,
+                        original_name TEXT,
+                        file_type TEXT,
+                        file_size_mb REAL,
+                        atten_lim_db INTEGER,
+                        duration_sec REAL,
+                        status TEXT,
+                        error_info TEXT,
+                        cache_hit INTEGER NOT NULL DEFAULT 0,
+                        skipped_ratio REAL
+                    )""")
+                # 舊版資料庫補上後來新增的欄位
+                columns = {row[1] for row in conn.execute("PRAGMA table_info(usage)")}
+                if "skipped_ratio" not in columns:
+                    conn.execute("ALTER TABLE usage ADD COLUMN skipped_ratio REAL")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_created ON usage (created_ts)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_user ON usage (user_name, created_ts)")
+                # 各處理階段耗時 (上傳寫入、提取、模型載入、每段降噪、正規化、寫入、封裝...)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS stage_spans (
+                        usage_id INTEGER NOT NULL REFERENCES usage (id),
+                        seq INTEGER NOT NULL,
+                        stage TEXT NOT NULL,
+                        seconds REAL NOT NULL,
+                        PRIMARY KEY (usage_id, seq)
+                    )""")
+                conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+                is_new = conn.execute("SELECT COUNT(*) FROM counters").fetchone()[0] == 0
+                if is_new:
+                    conn.executemany("INSERT INTO counters (name, value) VALUES (?, 0)",
+                                     [("total",), ("success",), ("failed",), ("cache_hit",)])
+                    _import_legacy_csv(conn)
+        finally:
+            conn.close()
+        _initialized = True
+
+
+def _insert(conn, created_ts, created_at, user_name, original_name, file_type, file_size_mb,
+            atten_lim_db, duration_sec, status, error_info, cache_hit, skipped_ratio=None):
+    cursor = conn.execute(
+        "INSERT INTO usage (created_ts, created_at, user_name, original_name, file_type, file_size_mb,"
+        " atten_lim_db, duration_sec, status, error_info, cache_hit, skipped_ratio)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (created_ts, created_at, user_name, original_name, file_type, file_size_mb,
+         atten_lim_db, duration_sec, status, error_info, int(cache_hit), skipped_ratio))
+    # 累計計數器與明細在同一個交易內更新，總數查詢永遠是 O(1)
+    names = ["total", "success" if status == STATUS_SUCCESS else "failed"]
+    if cache_hit:
+        names.append("cache_hit")
+    conn.executemany("UPDATE counters SET value = value + 1 WHERE name = ?", [(name,) for name in names])
+    return cursor.lastrowid
+
+
+def _import_legacy_csv(conn):
+    if not os.path.isfile(LEGACY_CSV_FILE):
+        return
+    with open(LEGACY_CSV_FILE, "r", encoding="utf-8-sig", newline="") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            if len(row) < 9:
+                continue
+            try:
+                created = datetime.datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S").replace(tzinfo=TZ_TAIPEI)
+                cache_hit = "快取" in row[7]
+                status = STATUS_SUCCESS if row[7].startswith(STATUS_SUCCESS) else STATUS_FAILED
+                _insert(conn, created.timestamp(), row[0], row[1], row[2], row[3], float(row[4]),
+                        int(float(row[5])), float(row[6]), status, row[8], cache_hit)
+            except ValueError:
+                continue
+
+
+def log_usage(user_name, original_name, file_size_mb, atten_lim_db, duration_sec, status, error_info, cache_hit=False,
+              spans=None, skipped_ratio=None):
+    """寫入一筆使用紀錄 (spans 為 [{"stage", "seconds"}, ...] 時一併寫入各階段耗時；skipped_ratio 為略過的靜音比例)"""
+    try:
+        init_store()
+        now = datetime.datetime.now(TZ_TAIPEI)
+        # 判斷檔案類型
+        ext = os.path.splitext(original_name)[1].lower()
+        file_type = "音檔" if ext in AUDIO_EXTENSIONS else "影片"
+        conn = _connect()
+        try:
+            with conn:
+                usage_id = _insert(conn, now.timestamp(), now.strftime("%Y-%m-%d %H:%M:%S"), user_name, original_name,
+                                   file_type, file_size_mb, atten_lim_db, duration_sec, status, error_info, cache_hit,
+                                   skipped_ratio)
+                if spans:
+                    conn.executemany("INSERT INTO stage_spans (usage_id, seq, stage, seconds) VALUES (?, ?, ?, ?)",
+                                     [(usage_id, seq, item["stage"], item["seconds"]) for seq, item in enumerate(spans)])
+        finally:
+            conn.close()
+    except Exception:
+        pass
+
+
+def get_counters():
+    """讀取累計計數器 (總數、成功、失敗、快取命中)"""
+    init_store()
+    conn = _connect()
+    try:
+        return dict(conn.execute("SELECT name, value FROM counters").fetchall())
+    finally:
+        conn.close()
+
+
+def get_recent(limit=3):
+    """讀取最近幾筆紀錄 (以 CSV 欄位順序回傳)"""
+    init_store()
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT created_at, user_name, original_name, file_type, file_size_mb, atten_lim_db, duration_sec,"
+            " status, error_info, cache_hit, skipped_ratio FROM usage ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return list(reversed(rows))
+    finally:
+        conn.close()
+
+
+def get_summary(days=14):
+    """管理員統計：近 N 天每日件數、成功工作的處理時間中位數、失敗率與各階段平均耗時 (只掃描索引範圍內的資料)"""
+    init_store()
+    since = time.time() - days * 86400
+    conn = _connect()
+    try:
+        per_day = conn.execute(
+            "SELECT substr(created_at, 1, 10) AS day, COUNT(*) FROM usage WHERE created_ts >= ?"
+            " GROUP BY day ORDER BY day", (since,)).fetchall()
+        total, failed = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(status = ?), 0) FROM usage WHERE created_ts >= ?",
+            (STATUS_FAILED, since)).fetchone()
+        successes = conn.execute(
+            "SELECT COUNT(*) FROM usage WHERE created_ts >= ? AND status = ? AND cache_hit = 0",
+            (since, STATUS_SUCCESS)).fetchone()[0]
+        median = None
+        if successes:
+            median = conn.execute(
+                "SELECT duration_sec FROM usage WHERE created_ts >= ? AND status = ? AND cache_hit = 0"
+                " ORDER BY duration_sec LIMIT 1 OFFSET ?", (since, STATUS_SUCCESS, successes // 2)).fetchone()[0]
+        # 各階段在有紀錄的工作中平均每件耗時，用來判斷瓶頸在 ffmpeg、模型運算還是寫檔
+        stages = conn.execute(
+            "SELECT s.stage, COUNT(DISTINCT s.usage_id), SUM(s.seconds) FROM stage_spans s"
+            " JOIN usage u ON u.id = s.usage_id WHERE u.created_ts >= ? GROUP BY s.stage", (since,)).fetchall()
+        return {
+            "per_day": per_day,
+            "stages": [(stage, jobs, total / jobs) for stage, jobs, total in stages],
+            "total": total,
+            "failure_rate": failed / total if total else 0.0,
+            "median_duration_sec": median,
+        }
+    finally:
+        conn.close()
+
+
+def export_csv(path):
+    """以游標逐列串流寫出完整 CSV (utf-8-sig 確保 Excel 開啟時不會有中文亂碼)，不會把整個日誌載入記憶體"""
+    init_store()
+    conn = _connect()
+    try:
+        with open(path, "w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_HEADER)
+            cursor = conn.execute(
+                "SELECT created_at, user_name, original_name, file_type, file_size_mb, atten_lim_db, duration_sec,"
+                " status, error_info, CASE cache_hit WHEN 1 THEN '是' ELSE '否' END,"
+                " CASE WHEN skipped_ratio IS NULL THEN '' ELSE printf('%.1f%%', skipped_ratio * 100) END"
+                " FROM usage ORDER BY id")
+            for row in cursor:
+                writer.writerow(row)
+    finally:
+        conn.close()
+    return path
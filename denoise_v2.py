@@ -5,11 +5,25 @@ import tempfile
 import shutil
 import warnings
 import time
-import torch
 import torchaudio
 import datetime
-import csv
 import uuid
+import hashlib
+from concurrent.futures.process import BrokenProcessPool
+from denoise_engine import (
+    init_model, create_worker_pool, model_version, auto_batch_size, DEFAULT_BACKEND, BYTES_PER_SAMPLE,
+    DEFAULT_CHUNK_SEC, DEFAULT_CONTEXT_SEC, DEFAULT_OVERLAP_SEC, DEFAULT_SHARD_SEC
+)
+from denoise_pipeline import run_pipeline, run_preview, output_name_for, inspect_input
+from denoise_io import PCM_BYTES, probe_duration, spool_upload, channel_layout, encode_preview_proxy, preview_proxy_name
+import denoise_jobs
+import denoise_cache
+import denoise_usage
+import denoise_metrics
+import denoise_files
+import denoise_scheduler
+import denoise_janitor
+from denoise_usage import log_usage
 
 # 忽略警告
 warnings.filterwarnings("ignore")
@@ -143,202 +157,458 @@ if "processed_file_path" not in st.session_state:
     st.session_state.processed_file_path = None
 if "processed_file_name" not in st.session_state:
     st.session_state.processed_file_name = None
-if "is_processing" not in st.session_state:
-    st.session_state.is_processing = False
 if "error_message" not in st.session_state:
     st.session_state.error_message = None
-if "process_target" not in st.session_state:
-    st.session_state.process_target = None
-
-# ================= 📊 系統日誌與統計 (升級 CSV 版) =================
-LOG_FILE = "denoise_usage_log.csv"
+if "preview" not in st.session_state:
+    st.session_state.preview = None
+if "job_id" not in st.session_state:
+    # 重新整理頁面後，從網址參數取回先前送出的工作編號
+    st.session_state.job_id = st.query_params.get("job")
 
+# ================= 📊 系統日誌與統計 (SQLite 版) =================
 # 安全升級：優先從 Streamlit Secrets 讀取密碼
 if "ADMIN_PASSWORD" in st.secrets:
     ADMIN_PASSWORD = st.secrets["ADMIN_PASSWORD"]
 else:
     ADMIN_PASSWORD = "ilrdf"
 
-def log_usage(user_name, original_name, file_size_mb, atten_lim_db, duration_sec, status, error_info):
-    """將使用紀錄完整寫入本地 CSV 檔案"""
-    try:
-        # 強制設定為台灣台北時間 (UTC+8)
-        tz_taipei = datetime.timezone(datetime.timedelta(hours=8))
-        timestamp = datetime.datetime.now(tz_taipei).strftime("%Y-%m-%d %H:%M:%S")
-        
-        # 判斷檔案類型
-        ext = os.path.splitext(original_name)[1].lower()
-        file_type = "音檔" if ext in [".wav", ".mp3", ".m4a", ".aac", ".flac"] else "影片"
-        
-        file_exists = os.path.isfile(LOG_FILE)
-        
-        # 使用 utf-8-sig 確保 Excel 開啟時不會有中文亂碼
-        with open(LOG_FILE, "a", encoding="utf-8-sig", newline="") as f:
-            writer = csv.writer(f)
-            # 若檔案不存在，先寫入標題列
-            if not file_exists:
-                writer.writerow(["處理時間", "使用者姓名", "原始檔名", "檔案類型", "檔案大小(MB)", "降噪強度(dB)", "處理耗時(秒)", "處理狀態", "錯誤詳細資訊"])
-            
-            # 寫入本次數據
-            writer.writerow([timestamp, user_name, original_name, file_type, file_size_mb, atten_lim_db, duration_sec, status, error_info])
-    except Exception:
-        pass
+@st.cache_data(ttl=60, show_spinner=False)
+def get_usage_summary():
+    """管理員統計每分鐘最多查詢一次，避免每次互動都重新計算"""
+    return denoise_usage.get_summary(days=14)
 
-def get_usage_data():
-    """讀取總處理資料"""
+# ================= 🎚️ 部署參數 =================
+def get_setting(key, default):
+    """依序從 Streamlit Secrets、環境變數讀取部署參數，皆未設定則使用預設值"""
     try:
-        if os.path.exists(LOG_FILE):
-            with open(LOG_FILE, "r", encoding="utf-8-sig") as f:
-                lines = f.readlines()
-                return lines
-        return []
+        if key in st.secrets:
+            return type(default)(st.secrets[key])
     except Exception:
-        return []
-
-# ================= 🩹 系統補丁 =================
-def apply_patches():
-    try:
-        import df.utils
-        df.utils.get_git_root = lambda: "."
-        df.utils.get_commit_hash = lambda: "web_v1"
-        df.utils.get_branch_name = lambda: "master"
-    except ImportError:
         pass
+    return type(default)(os.environ.get(key, default))
+
+# 串流引擎分段長度 (秒)：調小可讓進度更新更頻繁、峰值記憶體更低
+CHUNK_SEC = get_setting("CHUNK_SEC", DEFAULT_CHUNK_SEC)
+# 每段前方的暖機上下文與交界交叉淡化長度 (秒)
+CONTEXT_SEC = get_setting("CONTEXT_SEC", DEFAULT_CONTEXT_SEC)
+OVERLAP_SEC = get_setting("OVERLAP_SEC", DEFAULT_OVERLAP_SEC)
+# 一次前向運算疊幾段視窗 (0 = 依可用記憶體自動決定)
+BATCH_SIZE = get_setting("BATCH_SIZE", 0)
+# 平行模式：工作行程數 (0 或 1 = 關閉，由目前行程依序處理) 與每個分片長度 (秒)
+PARALLEL_WORKERS = get_setting("PARALLEL_WORKERS", 0)
+SHARD_SEC = get_setting("SHARD_SEC", DEFAULT_SHARD_SEC)
+# 快速試聽最多等待背景工作讓出運算資源的秒數，逾時則提示稍後再試
+PREVIEW_WAIT_SEC = get_setting("PREVIEW_WAIT_SEC", 20)
+# 背景工作佇列：同時處理的工作數與排隊上限 (超過上限時拒絕新工作，避免伺服器過載)
+JOB_WORKERS = get_setting("JOB_WORKERS", 1)
+MAX_QUEUED_JOBS = get_setting("MAX_QUEUED_JOBS", 20)
+# CPU 資源排程：所有工作共用的執行緒總數 (0 = 全部核心) 與每個工作至少分得的執行緒數；
+# 核心或記憶體不足時新工作會等待，搭配 JOB_WORKERS > 1 才會有多個工作同時執行
+CPU_BUDGET = get_setting("CPU_BUDGET", 0)
+MIN_JOB_THREADS = get_setting("MIN_JOB_THREADS", 1)
+# 推論後端：torch (原始模型) / int8 (動態量化) / torchscript (凍結靜態圖)；啟用前會先與原始模型比對輸出
+INFERENCE_BACKEND = get_setting("INFERENCE_BACKEND", DEFAULT_BACKEND)
+# 靜音略過：明顯比說話聲小的停頓 (長時間停頓、架設器材) 不送進模型，直接衰減 (1 = 開啟，0 = 關閉，預設關閉)
+SKIP_SILENCE = get_setting("SKIP_SILENCE", 0)
+# 聲道處理預設值："" = 混成單聲道、channels = 保留原始聲道、streams = 保留影片的所有音軌 (可在側邊欄逐次調整)
+CHANNEL_MODE = get_setting("CHANNEL_MODE", "")
+CHANNEL_MODES = {"": "混成單聲道", "channels": "保留原始聲道 (立體聲 / 多聲道)", "streams": "保留所有音軌 (多音軌影片)"}
+# 結果快取與解碼快取的容量上限 (MB)，超過時淘汰最久未使用的項目
+RESULT_CACHE_MB = get_setting("RESULT_CACHE_MB", 2048)
+PCM_CACHE_MB = get_setting("PCM_CACHE_MB", 2048)
+# 暫存清理：已完成的工作與快取閒置超過 WORK_TTL_HOURS 小時即刪除，失敗的工作保留 FAILED_TTL_HOURS 小時供「重試」續跑；
+# 暫存總容量 (工作資料夾、試聽暫存與快取) 超過 WORK_QUOTA_MB 或磁碟剩餘空間低於 MIN_FREE_DISK_MB 時
+# 從最久未使用的開始刪除，仍不足時拒絕新工作
+WORK_TTL_HOURS = get_setting("WORK_TTL_HOURS", 24.0)
+FAILED_TTL_HOURS = get_setting("FAILED_TTL_HOURS", 1.0)
+WORK_QUOTA_MB = get_setting("WORK_QUOTA_MB", 10240)
+MIN_FREE_DISK_MB = get_setting("MIN_FREE_DISK_MB", 1024)
+# 串流檔案伺服器：成果檔與預覽檔由獨立連接埠直接從磁碟傳送 (0 = 關閉)
+# 只有設定 FILE_SERVER_URL (瀏覽器可連到的公開網址，通常是反向代理轉到 FILE_SERVER_HOST:FILE_SERVER_PORT 的路徑) 時才啟用，
+# 未設定時一律由 Streamlit 傳送 (HTTPS、雲端平台只開放網頁連接埠時也能使用)；預設只接受本機連線
+FILE_SERVER_HOST = get_setting("FILE_SERVER_HOST", "127.0.0.1")
+FILE_SERVER_PORT = get_setting("FILE_SERVER_PORT", 8502)
+FILE_SERVER_URL = get_setting("FILE_SERVER_URL", "")
+# Prometheus 文字格式指標檔 (各階段耗時直方圖、佇列長度、模型載入次數)，空字串 = 不輸出
+METRICS_FILE = get_setting("METRICS_FILE", os.path.join(tempfile.gettempdir(), "denoise_metrics.prom"))
 
 # ================= 🧠 AI 模型快取區 =================
 @st.cache_resource(show_spinner="正在將 AI 模型載入伺服器記憶體 (僅需一次)...")
 def load_ai_model():
+    # 只有快取未命中、真正初始化模型時才會執行到這裡
+    denoise_metrics.count_model_load()
     try:
-        apply_patches()
-        from df.enhance import init_df
-        model, df_state, _ = init_df(model_base_dir=None)
-        return model, df_state
+        return init_model(INFERENCE_BACKEND)
     except ImportError as e:
         raise RuntimeError(f"套件載入失敗！雲端真實錯誤訊息: {str(e)}")
     except Exception as e:
         raise RuntimeError(f"模型初始化發生錯誤: {str(e)}")
 
+@st.cache_resource(show_spinner="正在啟動平行運算工作行程...")
+def get_worker_pool(workers):
+    """建立並快取平行降噪行程池，每個工作行程只會載入一次模型"""
+    return create_worker_pool(workers, INFERENCE_BACKEND, threads=denoise_scheduler.snapshot()["budget"])
+
+def load_model_timed(spans):
+    """載入模型並記錄為 model_load (實際初始化) 或 model_cache_hit (已在記憶體中) 階段"""
+    loads = denoise_metrics.model_loads()
+    start = time.perf_counter()
+    model, df_state = load_ai_model()
+    stage = "model_load" if denoise_metrics.model_loads() > loads else "model_cache_hit"
+    denoise_metrics.record(spans, stage, time.perf_counter() - start)
+    return model, df_state
+
+def resolve_job_file(job_id, kind):
+    """檔案伺服器查詢：只提供已完成工作的成果檔 (下載)、預覽檔 (內嵌播放) 與以代碼分享的匯出檔"""
+    if not job_id.isalnum():
+        return None
+    if kind == denoise_files.KIND_EXPORT:
+        shared = denoise_files.shared_file(job_id)
+        return (shared[0], shared[1], False) if shared else None
+    job = denoise_jobs.get_job(job_id)
+    if not job or job["status"] != denoise_jobs.STATUS_DONE:
+        return None
+    denoise_jobs.touch_job(job_id)
+    if kind == denoise_files.KIND_DOWNLOAD:
+        return job["output_path"], job["output_name"], False
+    if kind == denoise_files.KIND_PREVIEW:
+        # 預覽版本產生失敗時退回成果檔 (一樣分段傳送)
+        path = job.get("preview_path") or job["output_path"]
+        return path, os.path.basename(path), True
+    return None
+
+def export_usage_csv():
+    """產生完整使用數據 CSV 並回傳內容 (未啟用檔案伺服器時，按下下載按鈕才執行)"""
+    export_path = os.path.join(tempfile.gettempdir(), f"{denoise_janitor.EXPORT_PREFIX}{uuid.uuid4().hex}.csv")
+    try:
+        denoise_usage.export_csv(export_path)
+        with open(export_path, "rb") as f:
+            return f.read()
+    finally:
+        if os.path.exists(export_path):
+            os.remove(export_path)
+
+@st.cache_resource
+def get_file_server():
+    """啟動串流檔案伺服器 (整個伺服器只需一次)，未設定公開網址、關閉或連接埠被占用時回傳 None"""
+    if not FILE_SERVER_PORT or not FILE_SERVER_URL:
+        return None
+    try:
+        return denoise_files.start_file_server(resolve_job_file, FILE_SERVER_HOST, FILE_SERVER_PORT)
+    except OSError:
+        return None
+
+def make_preview_proxy(job, is_audio_only, threads=0):
+    """成果完成時產生一次低位元率預覽版本，失敗時回傳 None (不影響成果本身)"""
+    preview_path = os.path.join(job["work_dir"], preview_proxy_name(is_audio_only))
+    try:
+        encode_preview_proxy(job["output_path"], preview_path, is_audio_only, threads=threads)
+        return preview_path
+    except Exception:
+        return None
+
+def export_metrics():
+    """更新 Prometheus 指標檔 (工作送出、開始與結束時呼叫)"""
+    if not METRICS_FILE:
+        return
+    running, queued = denoise_jobs.queue_stats()
+    resources = denoise_scheduler.snapshot()
+    disk = denoise_janitor.usage()
+    gauges = {"queue_depth": queued, "jobs_running": running, "cpu_budget_threads": resources["budget"],
+              "cpu_allocated_threads": resources["allocated"], "jobs_waiting_resources": resources["waiting"],
+              "work_dir_bytes": disk["work_bytes"]}
+    if disk["free_bytes"] is not None:
+        gauges["disk_free_bytes"] = disk["free_bytes"]
+    try:
+        denoise_metrics.write_metrics_file(METRICS_FILE, gauges)
+    except OSError:
+        pass
+
 # ================= 🛠️ 核心處理邏輯 =================
-def process_media(source, atten_lim_db, user_name):
-    """處理影音檔案的核心函式，並包含完整的數據紀錄與智能音量優化"""
+def process_media(job, report):
+    """背景工作執行的降噪流程，並包含完整的數據紀錄與智能音量優化"""
     global_start_time = time.time()
+    # 接續送出工作時已記錄的階段 (模型載入、上傳寫入)
+    spans = list(job.get("spans") or [])
     
-    original_name = source.name
-    # 計算檔案大小 (MB)，保留兩位小數
-    file_size_mb = round(source.size / (1024 * 1024), 2)
-        
-    name, ext = os.path.splitext(original_name)
-    audio_extensions = (".wav", ".mp3", ".m4a", ".aac", ".flac")
-    is_audio_only = ext.lower() in audio_extensions
-    output_ext = ext if is_audio_only else ".mp4"
-    
-    final_output_name = f"{name}_{atten_lim_db}db{output_ext}"
-
-    work_dir = tempfile.mkdtemp(prefix="denoise_")
-    input_path = os.path.join(work_dir, original_name)
-    output_path = os.path.join(work_dir, final_output_name)
-    temp_noisy = os.path.join(work_dir, "temp_noisy.wav")
-    temp_clean = os.path.join(work_dir, "temp_clean.wav")
+    user_name = job["owner"]
+    original_name = job["original_name"]
+    atten_lim_db = job["atten_lim_db"]
+    file_size_mb = job["file_size_mb"]
+    _, is_audio_only = output_name_for(original_name, atten_lim_db)
+    channel_mode = job.get("channel_mode", "")
+    # 所有聲道與音軌疊成同一個 batch 送進模型，成本接近單聲道
+    layout = channel_layout(job.get("media"), is_audio_only, keep_channels=bool(channel_mode),
+                            all_streams=channel_mode == "streams")
 
     try:
-        # 1. 準備來源檔案
-        with open(input_path, "wb") as f:
-            f.write(source.getbuffer())
-
-        # 2. 提取音訊
-        cmd_extract = [
-            "ffmpeg", "-y", "-i", input_path, "-vn", "-acodec", "pcm_s16le", 
-            "-ar", "48000", "-ac", "1", temp_noisy, "-hide_banner", "-loglevel", "error"
-        ]
-        subprocess.run(cmd_extract, check=True, capture_output=True)
-
-        # 3. AI 降噪運算
-        model, df_state = load_ai_model()
-        from df.enhance import load_audio, save_audio, enhance
-        
-        audio, _ = load_audio(temp_noisy, sr=df_state.sr())
-        total_samples = audio.shape[-1]
-        
-        chunk_size = df_state.sr() * 10 
-        num_chunks = (total_samples + chunk_size - 1) // chunk_size
-        
-        progress_bar = st.progress(0)
-        time_text = st.empty()
-        
-        enhanced_chunks = []
+        model, df_state = load_model_timed(spans)
+
+        # 等待 CPU 與記憶體：核心已被其他工作分完或記憶體不足時在此排隊，不與執行中的工作互搶
+        def on_wait(wait_sec, position):
+            report(0.0, f"🕒 等待運算資源中... `已等待 {int(wait_sec)} 秒` (前面還有 {position} 件)")
+
+        # 自動批次在此先決定好並交給引擎，記憶體估計與實際疊的段數一致
+        window_samples = int((CONTEXT_SEC + CHUNK_SEC + OVERLAP_SEC) * df_state.sr())
+        batch_size = BATCH_SIZE if BATCH_SIZE > 0 else auto_batch_size(window_samples, channels=sum(layout))
+        memory = window_samples * sum(layout) * BYTES_PER_SAMPLE * batch_size
+        with denoise_metrics.span(spans, "resource_wait"):
+            threads = denoise_scheduler.acquire(job["id"], memory, on_wait=on_wait)
+        # torch 的執行緒數是整個行程共用的設定，由排程依執行中的工作數統一調整；分得的 threads 用於 ffmpeg
+        denoise_jobs.update_job(job["id"], threads=threads, wait_sec=round(denoise_scheduler.wait_time(job["id"]), 1))
+        export_metrics()
+
+        report(0.0, "⏳ 步驟 1/3: 正在提取並轉換音訊格式...")
+        pool = get_worker_pool(PARALLEL_WORKERS) if PARALLEL_WORKERS > 1 else None
         start_time = time.time()
-
-        for i in range(num_chunks):
-            start_idx = i * chunk_size
-            end_idx = min(start_idx + chunk_size, total_samples)
-            
-            audio_chunk = audio[:, start_idx:end_idx]
-            clean_chunk = enhance(model, df_state, audio_chunk, atten_lim_db=atten_lim_db)
-            enhanced_chunks.append(clean_chunk)
-            
-            current_progress = (i + 1) / num_chunks
-            progress_bar.progress(current_progress)
-            
+        progress_base = [0]  # 續跑時已完成的樣本數，剩餘時間只依本次實際處理的速度估算
+        job_threads = [threads]
+
+        def on_progress(done_samples, total_samples):
+            # 其他工作開始或結束時重新分配執行緒 (已啟動的 ffmpeg 沿用開始時的設定，之後的預覽轉檔使用新的分配)
+            current_threads = denoise_scheduler.threads_for(job["id"])
+            if current_threads and current_threads != job_threads[0]:
+                job_threads[0] = current_threads
+                denoise_jobs.update_job(job["id"], threads=current_threads)
+            current_progress = done_samples / total_samples
             elapsed = time.time() - start_time
-            avg_time = elapsed / (i + 1)
-            remaining_time = int(avg_time * (num_chunks - (i + 1)))
-            time_text.markdown(f"**🤖 AI 運算中:** `已完成 {int(current_progress*100)}%` | `剩餘約 {remaining_time} 秒` (強度: {atten_lim_db}dB)")
-
-        # 將分段處理好的音訊合併
-        enhanced_audio = torch.cat(enhanced_chunks, dim=-1)
-        
-        # 🌟 v1.1 核心升級：智能音量正規化 (方案 A: 無損放大至 -1.0 dBFS)
-        # 設定目標音量上限為 -1.0 dB (約等於 0.891 的振幅，預留安全空間防破音)
-        target_db = -1.0
-        target_amplitude = 10 ** (target_db / 20)
-        # 找出整段音訊的最高音量峰值
-        max_amplitude = torch.max(torch.abs(enhanced_audio))
-        
-        # 如果聲音不是完全靜音，就將整體音量等比例放大至安全極限
-        if max_amplitude > 0:
-            enhanced_audio = enhanced_audio * (target_amplitude / max_amplitude)
-
-        # 儲存處理並優化過音量的音訊
-        save_audio(temp_clean, enhanced_audio, df_state.sr())
-
-        # 4. 合成最終影音檔案
-        if is_audio_only:
-            cmd_merge = [
-                "ffmpeg", "-y", "-i", temp_clean, "-c:a", "libmp3lame", 
-                "-q:a", "2", output_path, "-hide_banner", "-loglevel", "error"
-            ]
-        else:
-            cmd_merge = [
-                "ffmpeg", "-y", "-i", input_path, "-i", temp_clean, "-c:v", "copy", 
-                "-c:a", "aac", "-map", "0:v:0", "-map", "1:a:0", "-shortest", 
-                output_path, "-hide_banner", "-loglevel", "error"
-            ]
-            
-        subprocess.run(cmd_merge, check=True, capture_output=True)
-        
-        st.session_state.processed_file_path = output_path
-        st.session_state.processed_file_name = final_output_name
+            remaining_time = int(elapsed / max(done_samples - progress_base[0], 1) * (total_samples - done_samples))
+            report(current_progress, f"**🤖 AI 運算中:** `已完成 {int(current_progress*100)}%` | `剩餘約 {remaining_time} 秒` (強度: {atten_lim_db}dB)")
+
+        def on_resume(done_samples, total_samples):
+            progress_base[0] = done_samples
+            report(done_samples / total_samples,
+                   f"**⏩ 從中斷處繼續:** `已完成 {int(done_samples / total_samples * 100)}%` 的部分不必重新處理")
+
+        pcm_path = denoise_cache.pcm_cache_path(job["input_hash"], df_state.sr(), layout) if job["input_hash"] else None
+        if pcm_path and denoise_cache.touch_pcm(pcm_path):
+            report(0.0, "⚡ 已有此檔案的解碼快取，略過音訊提取...")
+        stats = run_pipeline(job["input_path"], job["output_path"], atten_lim_db, model, df_state, is_audio_only,
+                             progress_cb=on_progress, chunk_sec=CHUNK_SEC, context_sec=CONTEXT_SEC,
+                             overlap_sec=OVERLAP_SEC, batch_size=batch_size, pool=pool,
+                             shard_sec=SHARD_SEC, max_pending=PARALLEL_WORKERS * 2, pcm_cache_path=pcm_path,
+                             spans=spans, skip_silence=bool(SKIP_SILENCE), media=job.get("media"), layout=layout,
+                             ffmpeg_threads=threads, checkpoint_path=os.path.join(job["work_dir"], denoise_jobs.CHECKPOINT_FILE),
+                             checkpoint_key={"input_hash": job["input_hash"], "atten_lim_db": atten_lim_db,
+                                             "model_version": model_version(INFERENCE_BACKEND)},
+                             resume_cb=on_resume)
+        total_samples = stats.get("total_samples", 0)
+        skipped_ratio = stats.get("skipped_samples", 0) / total_samples if total_samples else 0.0
+        report(1.0, "🎞️ 正在產生網頁預覽版本...")
+        with denoise_metrics.span(spans, "proxy"):
+            preview_path = make_preview_proxy(job, is_audio_only, denoise_scheduler.threads_for(job["id"]))
+        denoise_jobs.update_job(job["id"], skipped_ratio=skipped_ratio, preview_path=preview_path)
+        with denoise_metrics.span(spans, "cache_store"):
+            denoise_cache.evict_pcm(PCM_CACHE_MB)
+            if job["cache_key"]:
+                denoise_cache.store_result(job["cache_key"], os.path.splitext(job["output_name"])[1],
+                                           job["output_path"], RESULT_CACHE_MB)
+                if preview_path:
+                    denoise_cache.store_result(job["cache_key"] + "_preview", os.path.splitext(preview_path)[1],
+                                               preview_path, RESULT_CACHE_MB)
         
-        # 成功後寫入 CSV Log
+        # 成功後寫入使用紀錄
         duration_sec = round(time.time() - global_start_time, 1)
-        log_usage(user_name, original_name, file_size_mb, atten_lim_db, duration_sec, "成功", "無")
+        log_usage(user_name, original_name, file_size_mb, atten_lim_db, duration_sec, "成功", "無", spans=spans,
+                  skipped_ratio=skipped_ratio)
         
+        if skipped_ratio > 0:
+            return True, f"處理成功！(其中 {skipped_ratio * 100:.0f}% 為靜音段落，已快速略過)"
         return True, "處理成功！"
 
     except subprocess.CalledProcessError as e:
         duration_sec = round(time.time() - global_start_time, 1)
         err_msg = e.stderr.decode("utf-8", errors="ignore") if e.stderr else "無詳細錯誤"
         full_err = f"FFmpeg 錯誤: {err_msg}"
-        log_usage(user_name, original_name, file_size_mb, atten_lim_db, duration_sec, "失敗", full_err)
+        log_usage(user_name, original_name, file_size_mb, atten_lim_db, duration_sec, "失敗", full_err, spans=spans)
         return False, full_err
     except Exception as e:
+        # 工作行程異常終止後行程池無法再使用，清除快取讓下次重建
+        if isinstance(e, BrokenProcessPool):
+            get_worker_pool.clear()
         duration_sec = round(time.time() - global_start_time, 1)
         full_err = f"發生錯誤: {str(e)}"
-        log_usage(user_name, original_name, file_size_mb, atten_lim_db, duration_sec, "失敗", full_err)
+        log_usage(user_name, original_name, file_size_mb, atten_lim_db, duration_sec, "失敗", full_err, spans=spans)
         return False, full_err
+    finally:
+        # 歸還資源，由其餘執行中或等待中的工作重新分配
+        denoise_scheduler.release(job["id"])
+
+@st.cache_resource
+def get_job_queue():
+    """啟動背景工作執行緒與暫存清理執行緒 (整個伺服器只需一次)"""
+    denoise_scheduler.configure(CPU_BUDGET, MIN_JOB_THREADS)
+    denoise_jobs.start_workers(process_media, workers=JOB_WORKERS, max_queued=MAX_QUEUED_JOBS,
+                               on_change=export_metrics)
+    denoise_janitor.configure(WORK_TTL_HOURS, FAILED_TTL_HOURS, WORK_QUOTA_MB, MIN_FREE_DISK_MB)
+    denoise_janitor.start()
+    return denoise_jobs
+
+def submit_job(source, atten_lim_db, user_name, spans=None, channel_mode=""):
+    """將上傳檔寫入工作資料夾並排入背景佇列，回傳工作編號；結果快取命中時直接完成
+
+    spans 為送出前已記錄的階段 (例如前台的模型載入)，會接續記錄上傳寫入並交給背景工作；
+    channel_mode 為聲道處理方式 (CHANNEL_MODES 的鍵)。
+    """
+    jobs = get_job_queue()
+    spans = list(spans or [])
+    output_name, _ = output_name_for(source.name, atten_lim_db)
+    # 計算檔案大小 (MB)，保留兩位小數
+    file_size_mb = round(source.size / (1024 * 1024), 2)
+    # 磁碟空間不足時先清理閒置的工作，仍不足則拒絕 (此時只知道上傳檔大小，檢查完音訊長度後會再確認處理所需的空間)
+    denoise_janitor.ensure_space(source.size)
+    job = jobs.create_job(user_name, source.name, atten_lim_db, file_size_mb, output_name, channel_mode=channel_mode)
+
+    try:
+        return _prepare_job(jobs, job, source, user_name, spans, file_size_mb)
+    except Exception as e:
+        # 上傳檔寫入失敗 (例如磁碟已滿)：刪除工作，不留下永遠排不到的工作與不完整的上傳檔
+        jobs.remove_job(job["id"])
+        export_metrics()
+        if isinstance(e, RuntimeError):
+            raise
+        raise RuntimeError(f"上傳檔寫入失敗: {str(e)}") from e
+
+def _prepare_job(jobs, job, source, user_name, spans, file_size_mb):
+    """寫入上傳檔、查詢結果快取並以 ffprobe 檢查，通過後才排入佇列，回傳工作編號"""
+    atten_lim_db = job["atten_lim_db"]
+    output_name = job["output_name"]
+    channel_mode = job["channel_mode"]
+    # 分段寫入上傳檔的同時計算內容雜湊，作為快取鍵 (不會把整個檔案再複製一份到記憶體)
+    with denoise_metrics.span(spans, "upload_write"):
+        sha = hashlib.sha256()
+        spool_upload(source, job["input_path"], sha=sha)
+    input_hash = sha.hexdigest()
+    cache_key = denoise_cache.result_key(input_hash, atten_lim_db, model_version(INFERENCE_BACKEND), channel_mode,
+                                         skip_silence=bool(SKIP_SILENCE))
+    jobs.update_job(job["id"], input_hash=input_hash, cache_key=cache_key, spans=spans)
+
+    cached_path = denoise_cache.lookup_result(cache_key, os.path.splitext(output_name)[1])
+    if cached_path:
+        denoise_cache.copy_result(cached_path, job["output_path"])
+        # 預覽版本與成果一起快取，命中時不必重新轉檔
+        _, is_audio_only = output_name_for(source.name, atten_lim_db)
+        preview_name = preview_proxy_name(is_audio_only)
+        cached_preview = denoise_cache.lookup_result(cache_key + "_preview", os.path.splitext(preview_name)[1])
+        preview_path = None
+        if cached_preview:
+            preview_path = os.path.join(job["work_dir"], preview_name)
+            denoise_cache.copy_result(cached_preview, preview_path)
+        jobs.update_job(job["id"], status=jobs.STATUS_DONE, progress=1.0, cache_hit=True, preview_path=preview_path,
+                        message="處理成功！(快取命中)", finished_at=time.time())
+        log_usage(user_name, source.name, file_size_mb, atten_lim_db, 0.0, "成功", "無", cache_hit=True, spans=spans)
+        export_metrics()
+        return job["id"]
+
+    # 排隊前先以 ffprobe 檢查，損毀或沒有音軌的檔案立即回報失敗，不占用背景工作與模型
+    try:
+        with denoise_metrics.span(spans, "probe"):
+            media = inspect_input(job["input_path"])
+    except RuntimeError as e:
+        jobs.update_job(job["id"], status=jobs.STATUS_FAILED, message=f"發生錯誤: {str(e)}",
+                        finished_at=time.time(), spans=spans)
+        jobs.prune_failed_job(job["id"])
+        log_usage(user_name, source.name, file_size_mb, atten_lim_db, 0.0, "失敗", str(e), spans=spans)
+    else:
+        # 處理時還需要解碼後的 PCM (解碼快取與降噪暫存各一份) 與輸出檔 (以上傳檔大小估計) 的空間
+        _, is_audio_only = output_name_for(source.name, atten_lim_db)
+        layout = channel_layout(media, is_audio_only, keep_channels=bool(channel_mode), all_streams=channel_mode == "streams")
+        decoded_bytes = int((media["duration"] or 0) * load_ai_model()[1].sr() * sum(layout) * PCM_BYTES)
+        denoise_janitor.ensure_space(decoded_bytes * 2 + source.size)
+        jobs.update_job(job["id"], media=media, spans=spans)
+        jobs.enqueue_job(job["id"])
+    export_metrics()
+    return job["id"]
+
+def start_job(source, atten_lim_db, user_name, channel_mode=""):
+    """送出背景工作並記錄工作編號 (試聽暫存檔隨即清除)"""
+    # 先在前台載入模型 (僅第一次需要)，再交給背景工作處理
+    spans = []
+    load_model_timed(spans)
+    try:
+        st.session_state.job_id = submit_job(source, atten_lim_db, user_name, spans=spans, channel_mode=channel_mode)
+        st.session_state.error_message = None
+        st.query_params["job"] = st.session_state.job_id
+        clear_preview()
+    except RuntimeError as e:
+        st.session_state.error_message = str(e)
+    st.rerun()
+
+def make_preview(source, start_sec, duration_sec, atten_levels):
+    """只處理一小段音訊，一次產生多種強度的試聽片段 (同一個上傳檔只寫入磁碟一次)"""
+    preview = st.session_state.preview
+    # 試聽暫存閒置過久可能已被清理，此時重新寫入上傳檔
+    if not preview or preview["file_id"] != source.file_id or not os.path.exists(preview["input_path"]):
+        clear_preview()
+        try:
+            denoise_janitor.ensure_space(source.size)
+        except RuntimeError as e:
+            return False, str(e)
+        work_dir = tempfile.mkdtemp(prefix=denoise_janitor.PREVIEW_PREFIX)
+        input_path = os.path.join(work_dir, source.name)
+        spool_upload(source, input_path)
+        preview = {"file_id": source.file_id, "work_dir": work_dir, "input_path": input_path,
+                   "duration": probe_duration(input_path), "start_sec": 0, "clips": {}}
+        st.session_state.preview = preview
+
+    # 起點超過檔案長度時，自動改為最後一段
+    if preview["duration"]:
+        start_sec = max(0, min(start_sec, preview["duration"] - duration_sec))
+    try:
+        model, df_state = load_ai_model()
+        # 試聽同樣占用 CPU，與背景工作一起分配資源
+        memory = int(duration_sec * df_state.sr()) * BYTES_PER_SAMPLE
+        waiting = st.empty()
+
+        def on_wait(wait_sec, position):
+            waiting.caption(f"🕒 背景工作正在使用運算資源，試聽等待中... `已等待 {int(wait_sec)} 秒`")
+
+        preview_id = f"preview_{st.session_state.session_id}"
+        try:
+            denoise_scheduler.acquire(preview_id, memory, on_wait=on_wait, timeout=PREVIEW_WAIT_SEC)
+        except RuntimeError:
+            return False, "伺服器正在處理其他工作，暫時無法試聽，請稍後再試 (或直接開始處理)"
+        finally:
+            waiting.empty()
+        try:
+            preview["clips"] = run_preview(preview["input_path"], preview["work_dir"], start_sec, duration_sec,
+                                           atten_levels, model, df_state)
+        finally:
+            denoise_scheduler.release(preview_id)
+        preview["start_sec"] = start_sec
+        # 更新資料夾的修改時間，作為暫存清理的閒置依據
+        os.utime(preview["work_dir"], None)
+        return True, ""
+    except subprocess.CalledProcessError as e:
+        err_msg = e.stderr.decode("utf-8", errors="ignore") if e.stderr else "無詳細錯誤"
+        return False, f"FFmpeg 錯誤: {err_msg}"
+    except Exception as e:
+        return False, f"發生錯誤: {str(e)}"
+
+def clear_preview():
+    if st.session_state.preview:
+        shutil.rmtree(st.session_state.preview["work_dir"], ignore_errors=True)
+    st.session_state.preview = None
+
+def clear_current_job():
+    """刪除目前工作的暫存檔與此上傳檔的快取 (解碼快取、成果快取)，並重設畫面狀態"""
+    if st.session_state.job_id:
+        job = denoise_jobs.get_job(st.session_state.job_id)
+        denoise_jobs.remove_job(st.session_state.job_id)
+        # 執行中的工作會保留至結束，快取也一併保留
+        if job and job.get("input_hash") and job["status"] != denoise_jobs.STATUS_RUNNING:
+            denoise_cache.purge_input(job["input_hash"], [job.get("cache_key")])
+    st.session_state.job_id = None
+    st.session_state.processed_file_path = None
+    st.session_state.processed_file_name = None
+    st.session_state.error_message = None
+    st.query_params.pop("job", None)
+    clear_preview()
 
 # ================= 🖥️ 網頁前端介面 =================
 def main():
+    get_job_queue()
+    get_file_server()
     st.title("🎙️ Suyang! 族語影音降噪工具")
     
     # ---------------- 📖 操作指引區塊 (置於首頁大標題下) ----------------
@@ -351,12 +621,13 @@ def main():
         2. **🎛️ 調整強度 (可選)**：展開最左側的隱藏邊欄 (點擊 〉符號)，您可以填寫姓名並調整「降噪強度」。
            - **最佳建議 30-50dB**：最佳平衡點！能有效去除多數背景雜音，同時完美保留族語發音的自然度與氣音細節。
            - **最高 100dB**：僅適合背景「非常吵雜」（如強風、馬路邊、大聲冷氣）的環境，但可能使人聲稍悶。
+           - **🎧 不確定選多少？** 展開上傳區下方的「快速試聽」，只處理 10-20 秒片段，即可在右側並排比較多種強度，選定後再開始處理整個檔案。
         3. **🚀 執行降噪**：按下「開始降噪處理」按鈕，系統會顯示目前進度與預估時間，請耐心等待。
         4. **💾 預覽與下載**：處理完畢後，右側畫面會出現播放器。您可以先試聽/試看，確認滿意後再點擊按鈕下載。
 
         🔊 **[v1.1 升級] 智能音量優化**：降噪後系統會自動偵測並將人聲無損放大至安全極限 (-1dB)，保證聲音大聲清晰且絕不破音！
         
-        ⚠️ **隱私與安全聲明**：本系統為自動化即時處理。當您下載檔案或點擊「處理下一個」時，伺服器會自動銷毀您的所有影音暫存檔，絕不留存原始資料，請安心使用！
+        ⚠️ **隱私與安全聲明**：本系統為自動化即時處理。為了加快重複處理，成果與解碼後的音訊會暫存在伺服器上；點擊「處理下一個」或「清除所有暫存紀錄」時，伺服器會銷毀此檔案的所有影音暫存檔與快取，未清除的暫存檔與快取也會在閒置一段時間後自動刪除，不作其他用途，請安心使用！
         """)
 
     st.markdown("---") # 分隔線
@@ -381,54 +652,117 @@ def main():
         # 升級：將預設值改為 40dB，確保大多數使用者的初體驗是最佳的
         atten_lim = st.slider("降噪強度 (dB)", min_value=20, max_value=100, value=40, step=5)
         st.info("💡 **建議：最佳音質區間為 30-50dB**；若噪音極大再考慮往上調。")
+        modes = list(CHANNEL_MODES)
+        channel_mode = st.radio("🎚️ 聲道處理", options=modes, format_func=CHANNEL_MODES.get,
+                                index=modes.index(CHANNEL_MODE) if CHANNEL_MODE in modes else 0,
+                                help="立體聲訪談、多支麥克風或多語音軌的影片可保留原始配置 (純音檔最多保留為立體聲)")
         
         st.markdown("---")
         
         # 清除暫存按鈕
         if st.button("🗑️ 清除所有暫存紀錄", use_container_width=True):
-            if st.session_state.processed_file_path:
-                try: 
-                    shutil.rmtree(os.path.dirname(st.session_state.processed_file_path))
-                except Exception: 
-                    pass
-            st.session_state.processed_file_path = None
-            st.session_state.processed_file_name = None
-            st.session_state.is_processing = False
-            st.session_state.process_target = None
-            st.session_state.error_message = None
+            clear_current_job()
             st.rerun()
             
+        # 以工作編號取回結果 (換裝置或分享連結時使用)
+        lookup_id = st.text_input("🔖 以工作編號取回結果", help="送出工作後會顯示工作編號，重新整理頁面也會自動取回").strip()
+        if lookup_id and st.button("📂 取回", use_container_width=True):
+            if denoise_jobs.get_job(lookup_id):
+                st.session_state.processed_file_path = None
+                st.session_state.processed_file_name = None
+                st.session_state.error_message = None
+                st.session_state.job_id = lookup_id
+                st.query_params["job"] = lookup_id
+                st.rerun()
+            else:
+                st.warning("查無此工作編號，可能已被清除。")
+            
         # 管理員日誌區域
         st.markdown("---")
         st.subheader("🔑 管理員模式")
         admin_pwd = st.text_input("輸入管理密碼", type="password")
         
-        usage_data = get_usage_data()
-        # 扣除掉標題列 (Header) 的數量
-        total_count = len(usage_data) - 1 if len(usage_data) > 0 else 0
-        st.caption(f"📊 累計處理人次: **{total_count}** 次")
+        # 累計人次直接讀取計數器，不需掃描整份日誌
+        counters = denoise_usage.get_counters()
+        st.caption(f"📊 累計處理人次: **{counters.get('total', 0)}** 次")
         
         if admin_pwd == ADMIN_PASSWORD:
             st.success("密碼正確")
-            if usage_data:
-                log_content = "".join(usage_data)
-                # 升級：下載按鈕轉換為 CSV 格式下載
-                st.download_button(
-                    label="⬇️ 下載完整使用數據 (CSV)",
-                    data=log_content.encode("utf-8-sig"),
-                    file_name=f"denoise_log_{datetime.date.today()}.csv",
-                    mime="text/csv",
-                    use_container_width=True
-                )
+            # 暫存空間：背景清理每分鐘統計一次，也可手動立即清理
+            disk = denoise_janitor.usage()
+            st.markdown("**暫存空間:**")
+            d1, d2 = st.columns(2)
+            d1.metric("暫存總容量", f"{disk['work_bytes'] / 1024 ** 2:.0f} / {WORK_QUOTA_MB} MB")
+            d2.metric("磁碟剩餘", f"{disk['free_bytes'] / 1024 ** 3:.1f} GB" if disk["free_bytes"] is not None else "—")
+            st.caption(f"🗂️ 工作 {disk['jobs']} 件、試聽暫存 {disk['previews']} 份、快取 {disk['cache_bytes'] / 1024 ** 2:.0f} MB；"
+                       f"已自動清除 {disk['evicted']} 個項目")
+            for owner, size in disk["owners"]:
+                st.caption(f"👤 {owner}: {size / 1024 ** 2:.1f} MB")
+            if st.button("🧹 立即清理逾期暫存", use_container_width=True):
+                denoise_janitor.sweep()
+                st.rerun()
+            if counters.get("total", 0):
+                summary = get_usage_summary()
+                st.markdown("**近 14 天統計:**")
+                m1, m2 = st.columns(2)
+                m1.metric("處理件數", summary["total"])
+                m2.metric("失敗率", f"{summary['failure_rate'] * 100:.1f}%")
+                median = summary["median_duration_sec"]
+                st.metric("處理耗時中位數", f"{median:.1f} 秒" if median is not None else "—")
+                if summary["per_day"]:
+                    st.bar_chart({day: count for day, count in summary["per_day"]})
+                if summary["stages"]:
+                    st.markdown("**各階段平均耗時 (秒/件):**")
+                    st.bar_chart({stage: round(avg, 2) for stage, _, avg in summary["stages"]})
+                st.caption(f"⚡ 快取命中累計 {counters.get('cache_hit', 0)} 次")
+
+                export_name = f"denoise_log_{datetime.date.today()}.csv"
+                if get_file_server():
+                    # 升級：匯出檔逐列串流寫到暫存檔，再由檔案伺服器直接從磁碟傳送，不會讀進 Streamlit 的記憶體
+                    # (暫存檔在下載連結失效後由背景清理刪除)
+                    if st.button("📦 產生完整使用數據 (CSV)", use_container_width=True):
+                        export_path = os.path.join(tempfile.gettempdir(),
+                                                   f"{denoise_janitor.EXPORT_PREFIX}{st.session_state.session_id}.csv")
+                        token = denoise_files.share_file(denoise_usage.export_csv(export_path), export_name)
+                        st.session_state.usage_export = denoise_files.file_url(FILE_SERVER_URL, token,
+                                                                               denoise_files.KIND_EXPORT)
+                    if st.session_state.get("usage_export"):
+                        st.link_button("⬇️ 下載完整使用數據 (CSV)", url=st.session_state.usage_export,
+                                       use_container_width=True)
+                        st.caption("🔗 下載連結 10 分鐘內有效")
+                else:
+                    # 未啟用檔案伺服器：按下下載時才產生，不會每次互動都把整份日誌讀進記憶體
+                    st.download_button(
+                        label="⬇️ 下載完整使用數據 (CSV)",
+                        data=export_usage_csv,
+                        file_name=export_name,
+                        mime="text/csv",
+                        on_click="ignore",
+                        use_container_width=True
+                    )
                 
-                # 預覽最近 3 筆紀錄 (因為 CSV 較長，所以只預覽 3 筆避免版面過滿)
-                st.markdown("**最近使用紀錄 (CSV原始資料):**")
-                for line in usage_data[-3:]:
-                    if line.strip():
-                        st.caption(line.strip())
+                # 預覽最近 3 筆紀錄 (因為欄位較多，所以只預覽 3 筆避免版面過滿)
+                st.markdown("**最近使用紀錄:**")
+                for row in denoise_usage.get_recent(3):
+                    st.caption(",".join(str(value) for value in row))
             else:
                 st.write("目前尚無日誌紀錄。")
 
+    # ---------------- 背景工作狀態同步 ----------------
+    job = denoise_jobs.get_job(st.session_state.job_id) if st.session_state.job_id else None
+    if st.session_state.job_id and not job:
+        # 工作閒置過久已被暫存清理刪除 (或編號錯誤)，重設畫面狀態
+        clear_current_job()
+        st.info("先前的工作已逾期並從伺服器清除，請重新上傳檔案。")
+    elif job:
+        denoise_jobs.touch_job(job["id"])
+    job_active = bool(job) and job["status"] in denoise_jobs.ACTIVE_STATUSES
+    if job and job["status"] == denoise_jobs.STATUS_DONE:
+        st.session_state.processed_file_path = job["output_path"]
+        st.session_state.processed_file_name = job["output_name"]
+    elif job and job["status"] == denoise_jobs.STATUS_FAILED:
+        st.session_state.error_message = job["message"]
+
     # ---------------- 主畫面佈局 ----------------
     col1, col2 = st.columns([1, 1])
     
@@ -439,75 +773,120 @@ def main():
         supported = ("mp4", "mov", "avi", "mkv", "wav", "mp3", "m4a", "aac", "flac")
         uploaded_file = st.file_uploader("請選擇要降噪的檔案（最大900MB限制）", type=supported)
         
-        if uploaded_file and not st.session_state.processed_file_path:
+        can_start = uploaded_file and not st.session_state.processed_file_path and not job_active
+        if can_start:
             if st.button("🚀 開始降噪處理", use_container_width=True):
-                st.session_state.process_target = uploaded_file
-                st.session_state.is_processing = True
-                st.rerun()
-
-        # 處理進度顯示區塊
-        if st.session_state.is_processing:
-            with st.status("AI 降噪處理中...", expanded=True) as status:
-                st.write("⏳ 步驟 1/3: 正在提取並轉換音訊格式...")
                 # 升級：把目前使用者名稱 current_user 傳給處理函式作紀錄
-                success, msg = process_media(st.session_state.process_target, atten_lim, current_user)
-                
-                # 處理完畢更新狀態
-                st.session_state.is_processing = False
-                
-                if success: 
-                    status.update(label="✅ 處理完成！", state="complete")
-                    st.rerun()
-                else: 
-                    status.update(label="❌ 處理失敗", state="error")
-                    st.session_state.error_message = msg
-                    st.rerun()
+                start_job(uploaded_file, atten_lim, current_user, channel_mode)
+
+            # 快速試聽：只處理一小段，在右側比較多種強度後再決定
+            with st.expander("🎧 快速試聽 (先比較不同強度，再選定開始處理)", expanded=False):
+                preview_start = st.number_input("試聽起點 (秒)", min_value=0, value=0, step=5)
+                preview_len = st.slider("試聽長度 (秒)", min_value=10, max_value=20, value=15)
+                preview_levels = st.multiselect("比較強度 (dB)", options=list(range(20, 105, 5)), default=[30, 40, 60])
+                if st.button("🎧 產生試聽片段", use_container_width=True, disabled=not preview_levels):
+                    with st.spinner("正在產生試聽片段..."):
+                        ok, msg = make_preview(uploaded_file, preview_start, preview_len, sorted(preview_levels))
+                    if not ok:
+                        st.error(msg)
+
+        # 處理進度顯示區塊 (背景執行中，重新整理或離開頁面都不會中斷)
+        if job_active:
+            with st.status("AI 降噪處理中...", expanded=True):
+                st.caption(f"🔖 工作編號：`{job['id']}` (重新整理頁面後仍可取回結果)")
+                if job["status"] == denoise_jobs.STATUS_QUEUED:
+                    running, _ = denoise_jobs.queue_stats()
+                    st.write(f"🕒 排隊中，前面還有 {denoise_jobs.queue_position(job['id'])} 件工作 (處理中 {running} 件)...")
+                else:
+                    st.progress(job["progress"])
+                    st.markdown(job["message"])
+                    if job.get("threads"):
+                        budget = denoise_scheduler.snapshot()["budget"]
+                        st.caption(f"🧮 運算資源：分配 {job['threads']} / {budget} 個 CPU 執行緒"
+                                   f" (等待資源 {job.get('wait_sec') or 0:.1f} 秒)")
 
         # 錯誤訊息顯示區
         if st.session_state.error_message:
             st.error(st.session_state.error_message)
             if st.button("🔄 重試"): 
-                st.session_state.error_message = None
+                # 失敗的工作沿用已上傳的檔案與檢查點重新排隊，從中斷處繼續；無法續跑時才清除重來
+                if st.session_state.job_id and denoise_jobs.retry_job(st.session_state.job_id):
+                    st.session_state.error_message = None
+                else:
+                    clear_current_job()
                 st.rerun()
 
     # 右側欄位：預覽與下載區
     with col2:
         st.subheader("🎬 成果預覽與下載")
         
-        if st.session_state.processed_file_path and os.path.exists(st.session_state.processed_file_path):
+        if job and st.session_state.processed_file_path and os.path.exists(st.session_state.processed_file_path):
             file_ext = os.path.splitext(st.session_state.processed_file_name)[1].lower()
+            is_video = file_ext in (".mp4", ".mov", ".avi", ".mkv")
             
-            # 讀取檔案進行預覽
-            with open(st.session_state.processed_file_path, "rb") as f:
-                bytes_data = f.read()
-                
-            if file_ext in (".mp4", ".mov", ".avi", ".mkv"): 
-                st.video(bytes_data)
-            else: 
-                st.audio(bytes_data)
-                
-            # 下載按鈕
-            st.download_button(
-                label=f"⬇️ 下載降噪後檔案 ({st.session_state.processed_file_name})", 
-                data=bytes_data, 
-                file_name=st.session_state.processed_file_name, 
-                use_container_width=True
-            )
+            if get_file_server():
+                # 播放器與下載皆由串流檔案伺服器直接從磁碟分段傳送，不讀進記憶體
+                base_url = FILE_SERVER_URL
+                preview_url = denoise_files.file_url(base_url, job["id"], denoise_files.KIND_PREVIEW)
+                if is_video:
+                    st.video(preview_url)
+                else:
+                    st.audio(preview_url)
+                if job.get("preview_path"):
+                    st.caption("▶️ 線上預覽為低位元率版本，下載的檔案為完整品質。")
+                st.link_button(
+                    label=f"⬇️ 下載降噪後檔案 ({st.session_state.processed_file_name})",
+                    url=denoise_files.file_url(base_url, job["id"], denoise_files.KIND_DOWNLOAD),
+                    use_container_width=True
+                )
+            else:
+                # 檔案伺服器未啟用：改由 Streamlit 傳送。播放器只載入低位元率預覽版本 (不會把完整成果讀進記憶體)，
+                # 下載按鈕在點擊時才開啟檔案，不在每次重新執行頁面時讀取
+                preview_path = job.get("preview_path")
+                if preview_path and os.path.exists(preview_path):
+                    if is_video:
+                        st.video(preview_path)
+                    else:
+                        st.audio(preview_path)
+                    st.caption("▶️ 線上預覽為低位元率版本，下載的檔案為完整品質。")
+                else:
+                    st.caption("▶️ 預覽版本產生失敗，請下載檔案後播放。")
+                processed_path = st.session_state.processed_file_path
+                st.download_button(
+                    label=f"⬇️ 下載降噪後檔案 ({st.session_state.processed_file_name})",
+                    data=lambda: open(processed_path, "rb"),
+                    file_name=st.session_state.processed_file_name,
+                    on_click="ignore",
+                    use_container_width=True
+                )
             
             # 處理下一個檔案的按鈕 (包含清理暫存邏輯)
             if st.button("🔄 繼續處理下一個檔案", use_container_width=True):
-                try: 
-                    shutil.rmtree(os.path.dirname(st.session_state.processed_file_path))
-                except Exception: 
-                    pass
-                st.session_state.processed_file_path = None
-                st.session_state.processed_file_name = None
-                st.session_state.error_message = None
-                st.session_state.process_target = None
+                clear_current_job()
                 st.rerun()
+        elif can_start and st.session_state.preview and st.session_state.preview["clips"] \
+                and st.session_state.preview["file_id"] == uploaded_file.file_id \
+                and os.path.isdir(st.session_state.preview["work_dir"]):
+            # 試聽片段並排比較，選定強度後才開始處理整個檔案
+            preview = st.session_state.preview
+            st.markdown(f"**🎧 試聽片段** (從第 {int(preview['start_sec'])} 秒開始，皆已做音量優化)")
+            st.caption("原始音訊")
+            st.audio(preview["clips"][0])
+            levels = sorted(level for level in preview["clips"] if level)
+            for col, level in zip(st.columns(len(levels)), levels):
+                with col:
+                    st.markdown(f"**{level} dB**")
+                    st.audio(preview["clips"][level])
+                    if st.button(f"✅ 選用 {level}dB", key=f"pick_{level}", use_container_width=True):
+                        start_job(uploaded_file, level, current_user, channel_mode)
         else: 
             st.write("目前尚無處理好的檔案。")
 
+    # 工作進行中：每秒重新整理一次以更新進度
+    if job_active:
+        time.sleep(1)
+        st.rerun()
+
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,100 @@
+import os
+import math
+import shutil
+import pytest
+import torch
+import denoise_engine
+from denoise_pipeline import run_pipeline, inspect_input
+
+# ================= ⏩ 中斷後續跑 =================
+# 處理到一半時由 progress_cb 拋出例外模擬中斷，以相同參數重跑後的輸出必須與不中斷的結果逐位元組相同
+# (batch_size=1，批次的分組不受續跑位置影響)
+SECONDS = 14
+CHUNK_SEC = 2.0
+SHARD_SEC = 4.0
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture(scope="module")
+def model():
+    pytest.importorskip("df")
+    if not shutil.which("ffmpeg"):
+        pytest.skip("需要 ffmpeg")
+    return denoise_engine.init_model()
+
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = denoise_engine.create_worker_pool(2, threads=2)
+    yield pool
+    pool.shutdown()
+
+
+def write_input(path, sr):
+    """類語音 (150Hz 諧波 + 音節起伏) 加上固定種子的噪音"""
+    import soundfile as sf
+
+    generator = torch.Generator().manual_seed(0)
+    t = torch.arange(SECONDS * sr, dtype=torch.float64) / sr
+    voice = sum(torch.sin(2 * math.pi * 150 * k * t) / k for k in range(1, 8))
+    voice = voice * torch.clamp(torch.sin(2 * math.pi * 3 * t), min=0) ** 2
+    x = 0.2 * voice + 0.02 * torch.randn(t.shape[0], generator=generator, dtype=torch.float64)
+    sf.write(path, x.numpy(), sr, subtype="PCM_16")
+    return path
+
+
+def interrupt_after(samples):
+    def on_progress(done_samples, total_samples):
+        if done_samples >= samples:
+            raise Interrupted()
+    return on_progress
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("case", ["direct", "decode", "decode_short_prefix", "cached", "pool"])
+def test_resume_matches_uninterrupted_run(case, model, tmp_path, request):
+    model, df_state = model
+    sr = df_state.sr()
+    # 與模型取樣率相同的單聲道 WAV 直接讀取；其他取樣率經 ffmpeg 解碼
+    src = write_input(str(tmp_path / "in.wav"), sr if case == "direct" else 44100)
+    options = dict(chunk_sec=CHUNK_SEC, batch_size=1, media=inspect_input(src))
+    if case == "pool":
+        options.update(pool=request.getfixturevalue("pool"), shard_sec=SHARD_SEC)
+    pcm_path = None if case == "direct" else str(tmp_path / "cache.f32")
+
+    reference = str(tmp_path / "reference.wav")
+    run_pipeline(src, reference, 40, model, df_state, True,
+                 pcm_cache_path=pcm_path if case == "cached" else None, **options)
+    assert (case == "cached") == bool(pcm_path and os.path.exists(pcm_path))
+
+    output = str(tmp_path / "out.wav")
+    checkpoint = dict(pcm_cache_path=pcm_path, checkpoint_path=str(tmp_path / "checkpoint.json"),
+                      checkpoint_key={"input_hash": "test"})
+    with pytest.raises(Interrupted):
+        run_pipeline(src, output, 40, model, df_state, True, progress_cb=interrupt_after(int(SECONDS / 2 * sr)),
+                     **checkpoint, **options)
+    assert os.path.exists(checkpoint["checkpoint_path"])
+    if case == "decode_short_prefix":
+        # 已解碼的暫存檔比檢查點還短 (且不是完整的樣本)：不足的部分重新解碼
+        with open(output + ".in.f32", "r+b") as f:
+            f.truncate(int(sr * CHUNK_SEC) * 4 + 3)
+
+    resumed = []
+    stats = run_pipeline(src, output, 40, model, df_state, True,
+                         resume_cb=lambda done_samples, total_samples: resumed.append(done_samples),
+                         **checkpoint, **options)
+    assert stats["resumed_samples"] > 0
+    assert resumed == [stats["resumed_samples"]]
+    assert read(output) == read(reference)
+    assert not os.path.exists(checkpoint["checkpoint_path"])
+    assert not os.path.exists(output + ".in.f32")
+    if pcm_path:
+        # 續跑完成後解碼結果移入快取，內容與整段解碼相同
+        assert os.path.getsize(pcm_path) == stats["total_samples"] * 4
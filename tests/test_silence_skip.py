@@ -0,0 +1,101 @@
+import math
+import pytest
+import torch
+import denoise_engine
+from denoise_pipeline import peak_gain
+
+# ================= 🔇 靜音略過 =================
+# 合成訊號：類語音 = 150Hz 基頻諧波 + 每秒 4 個音節的起伏；噪音為固定種子的白噪音或粉紅噪音
+SR = 48000
+
+
+def db(value):
+    return 10 ** (value / 20)
+
+
+def noise(seconds, level_db, kind="white", seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    x = torch.randn(int(seconds * SR), generator=generator, dtype=torch.float64)
+    if kind == "pink":
+        spectrum = torch.fft.rfft(x)
+        spectrum /= torch.sqrt(torch.clamp(torch.arange(spectrum.shape[0], dtype=torch.float64), min=1))
+        x = torch.fft.irfft(spectrum, n=x.shape[0])
+    return x / torch.sqrt(torch.mean(x ** 2)) * db(level_db)
+
+
+def voice(seconds, level_db, syllables=True):
+    t = torch.arange(int(seconds * SR), dtype=torch.float64) / SR
+    phase = 2 * math.pi * torch.cumsum(150 + 50 * torch.sin(2 * math.pi * 0.3 * t), dim=0) / SR
+    x = sum(torch.sin(k * phase) / k for k in range(1, 12))
+    if syllables:
+        x = x * torch.clamp(torch.sin(2 * math.pi * 4 * t), min=0) ** 2
+    return x / torch.sqrt(torch.mean(x ** 2)) * db(level_db)
+
+
+def gate(seconds, on_sec, off_sec):
+    """前 on_sec 秒有聲、接著 off_sec 秒停頓，交替重複"""
+    t = torch.arange(int(seconds * SR), dtype=torch.float64) / SR
+    return ((t % (on_sec + off_sec)) < on_sec).double()
+
+
+def as_audio(x):
+    return x.float().unsqueeze(0)
+
+
+def skipped_ratio(audio, chunk_sec=10.0):
+    """以串流引擎相同的方式逐段詢問靜音判斷，回傳被略過的段落比例"""
+    is_silent = denoise_engine._make_silence_detector(SR, int(0.5 * SR))
+    hop = int(chunk_sec * SR)
+    results = [is_silent(audio[:, i:i + hop], audio[:, i:i + hop].shape[-1]) for i in range(0, audio.shape[-1], hop)]
+    return sum(results) / len(results)
+
+
+@pytest.mark.parametrize("level_db", [-30, -60])
+@pytest.mark.parametrize("kind", ["white", "pink"])
+def test_low_snr_speech_is_not_skipped(kind, level_db):
+    # 語音爆發比背景噪音低 5dB (音量平坦、沒有音節起伏)，整體音量判斷分不出來
+    x = noise(120, level_db, kind) + voice(120, level_db - 5, syllables=False) * gate(120, 4, 3)
+    assert skipped_ratio(as_audio(x)) == 0
+
+
+def test_steady_tone_is_not_skipped():
+    t = torch.arange(120 * SR, dtype=torch.float64) / SR
+    x = noise(120, -30, "pink") + math.sqrt(2) * db(-20) * torch.sin(2 * math.pi * 440 * t)
+    assert skipped_ratio(as_audio(x)) == 0
+
+
+@pytest.mark.parametrize("level_db", [-65, -90])
+def test_quiet_file_is_not_skipped_entirely(level_db):
+    # 沒有較大聲的內容可供比較時一律送進模型，避免整個檔案只被衰減後再正規化成原始噪音
+    assert skipped_ratio(as_audio(noise(60, level_db, "pink"))) == 0
+    assert skipped_ratio(torch.zeros(1, 60 * SR)) == 0
+
+
+@pytest.mark.parametrize("kind", ["white", "pink"])
+def test_pauses_between_speech_are_skipped(kind):
+    x = noise(120, -65, kind) + voice(120, -20) * gate(120, 20, 30)
+    ratio = skipped_ratio(as_audio(x))
+    assert 0.3 <= ratio <= 0.6
+
+
+def test_skipping_has_no_audible_difference():
+    # 略過靜音與全部送進模型的結果 (各自正規化峰值後)：有人聲的段落完全相同，
+    # 差異只出現在停頓中 (模型殘留的底噪 vs 直接衰減)，且遠低於節目音量
+    pytest.importorskip("df")
+    model, df_state = denoise_engine.init_model()
+    speaking = gate(60, 10, 20)
+    x = as_audio(noise(60, -65, "pink") + voice(60, -20) * speaking)
+    blocks = [x[:, i:i + SR] for i in range(0, x.shape[-1], SR)]
+    outputs = {}
+    for skip in (False, True):
+        stats = {}
+        out = torch.cat(list(denoise_engine.enhance_stream(model, df_state, iter(blocks), 40, chunk_sec=5.0,
+                                                           skip_silence=skip, stats=stats)), dim=-1)
+        outputs[skip] = out * peak_gain(float(out.abs().max()))
+        if skip:
+            assert stats["skipped_samples"] > 0
+    reference, skipped = outputs[False], outputs[True]
+    assert reference.shape == skipped.shape == x.shape
+    assert torch.equal(reference[:, speaking.bool()], skipped[:, speaking.bool()])
+    error_db = 10 * math.log10(float(torch.mean((skipped - reference) ** 2)) / float(torch.mean(reference ** 2)))
+    assert error_db < -30